@@ -12,33 +12,43 @@ import numpy as np
 #			 [1,1]]
 # 3. the names of each variable e.g ["A","B"]
 # The reason for having the index is it makes it easier to edit values and easier to print the factor.
+# The index grows much faster than the array (one row per combination, one column per variable), so it is only
+# built the first time something asks for it and is kept until the shape of the array changes.
+# A factor can also be kept in log space (log_space=True), where the array holds log values instead. Long chains of
+# products underflow to 0 in normal space, in log space product becomes add, marginalize becomes logsumexp and
+# condition becomes subtracting the logsumexp. An empty log space factor is full of -inf (log of 0).
 
 class Factor:
-	def __init__(self,names,pos_values):
-		array = np.zeros((pos_values))
-		indexes = np.zeros((np.prod(array.shape),len(names))).astype(int)
-		f = 1
-		for i in range(len(names)):
-			# fills the given column in the indexes
-			repeated = np.arange(array.shape[i]).repeat(np.prod(array.shape)/(f*array.shape[i]))
-			indexes[:,i]=np.tile(repeated,f)
-			f = f*array.shape[i]
+	def __init__(self,names,pos_values,log_space=False):
 		self.names = names
-		self.array = array
-		self.indexes = indexes
+		self.log_space = log_space
+		if(log_space):
+			self.array = np.full((pos_values),-np.inf)
+		else:
+			self.array = np.zeros((pos_values))
+		self._indexes = None
+	
+	@property
+	def indexes(self):
+		shape = self.array.shape
+		if(self._indexes is None or self._indexes.shape!=(int(np.prod(shape)),len(shape))):
+			self._indexes = np.indices(shape).reshape(len(shape),int(np.prod(shape))).T
+		return self._indexes
 		
 	# show the array in a nice format.
 	def __repr__(self):
 		array = self.array
-		indexes = self.indexes
 		names = self.names
 		name_lengths = [len(str(n)) for n in names]
 		formatter = "".join(["{:<"+str(l+2)+"}" for l in name_lengths])+"{}"
 		strings = []
-		strings.append(formatter.format(*(names+["Values (10 dp)"])))
-		for i in range(indexes.shape[0]):
-			val = array[tuple(indexes[i])].round(10)
-			strings.append(formatter.format(*(list(indexes[i])+[val])))
+		if(self.log_space):
+			strings.append(formatter.format(*(names+["Log values (10 dp)"])))
+		else:
+			strings.append(formatter.format(*(names+["Values (10 dp)"])))
+		for index in np.ndindex(array.shape):
+			val = array[index].round(10)
+			strings.append(formatter.format(*(list(index)+[val])))
 		return "".join([s+"\n" for s in strings])
 		
 	# set the value at a given position e.g myfactor.set([0,1],0.3)
@@ -59,51 +69,103 @@ class Factor:
 	
 	# returns an empty factor with the same names etc.
 	def copy_zeros(self):
-		new_factor = Factor(self.names,list(self.array.shape))
+		new_factor = Factor(self.names,list(self.array.shape),self.log_space)
 		return new_factor
 	
 	def copy(self):
-		new_factor = Factor(self.names,list(self.array.shape))
+		new_factor = Factor(self.names,list(self.array.shape),self.log_space)
 		new_factor.set_all(self.array.reshape(-1))
 		return new_factor
 		
+# moving a factor in and out of log space.
+def to_log_space(factor):
+	if(factor.log_space):
+		return factor.copy()
+	new_factor = Factor(factor.names,factor.array.shape,log_space=True)
+	with np.errstate(divide="ignore"):
+		new_factor.set_all(np.log(factor.array))
+	return new_factor
+
+def to_linear_space(factor):
+	if(not factor.log_space):
+		return factor.copy()
+	new_factor = Factor(factor.names,factor.array.shape)
+	new_factor.set_all(np.exp(factor.array))
+	return new_factor
+
+# log(sum(exp(array))) along some axes without underflow. The max is taken out first so the largest term is exp(0)=1.
+# Slices which are all -inf (all probabilities 0) give -inf.
+def logsumexp(array,axis=None,keepdims=False):
+	max_values = np.max(array,axis=axis,keepdims=True)
+	max_values[~np.isfinite(max_values)] = 0
+	with np.errstate(divide="ignore"):
+		summed = np.log(np.sum(np.exp(array-max_values),axis=axis,keepdims=keepdims))
+	if(not keepdims):
+		max_values = np.squeeze(max_values,axis=axis)
+	return summed+max_values
+
 # There are four major pieces of code to know:
 
 # 1. FACTOR CONDITIONING
 # 		returns the same factor but ensures the sum is 1 along a given set of axes.	
-def condition(factor,axis="none"):
+#		zero_policy decides what happens to a slice which sums to 0 and so can't be normalized:
+#		"nan" leaves it as nan (0/0), "uniform" spreads the probability evenly over the slice and "raise" throws an error.
+#		out is an optional factor with the same shape to write the result into, e.g condition(f,axis,out=f) works in place.
+zero_policies = ["nan","uniform","raise"]
+
+def condition(factor,axis="none",zero_policy="nan",out=None):
+	if(not zero_policy in zero_policies):
+		raise Exception('unknown zero_policy {}. Use one of {}'.format(zero_policy,zero_policies))
 	array = factor.array
-	indexes = factor.indexes
 	names = factor.names
 	# if axis is none, then normalize the whole array so the total probability is 1.
 	if(axis=="none" or len(axis)==0):
-		new_factor = Factor(names,array.shape)
-		new_factor.set_all(array/np.sum(array))
-		return new_factor
+		not_cond_var_index = list(range(len(names)))
 	else:
 		cond_var_index = [a for a in range(len(names)) if names[a] in axis]
 		if(len(cond_var_index)<1):
 			print("Error: couldn't find variable")
 			return None
+		# find all variables not in the axis list, these are the ones which get summed for the normalization.
+		not_cond_var_index = [b for b in range(len(names)) if not b in cond_var_index]
+	# keepdims leaves size 1 axes in place of the summed variables so the sums broadcast straight back over the array.
+	if(factor.log_space):
+		sums = logsumexp(array,axis=tuple(not_cond_var_index),keepdims=True)
+		zero_sums = (sums==-np.inf)
+	else:
+		sums = np.sum(array,axis=tuple(not_cond_var_index),keepdims=True)
+		zero_sums = (sums==0)
+	if(zero_policy=="raise" and np.any(zero_sums)):
+		raise Exception('{} slices sum to 0 and cannot be conditioned'.format(np.sum(zero_sums)))
+	if(out is None):
+		out = Factor(names,array.shape,factor.log_space)
+	elif(out.array.shape!=array.shape):
+		raise Exception('out has shape {} but the factor has shape {}'.format(out.array.shape,array.shape))
+	elif(out.array.dtype.kind!="f"):
+		out.array = out.array.astype(float)
+	out.names = names
+	out.log_space = factor.log_space
+	with np.errstate(divide="ignore",invalid="ignore"):
+		if(factor.log_space):
+			np.subtract(array,sums,out=out.array)
 		else:
-			# find all variables not in the axis list and get their sum. This is easy in numpy. 
-			# Gets the array created by summing out variables not in the axis list.
-			not_cond_var_index = [b for b in range(len(names)) if not b in cond_var_index]
-			sums = np.sum(array,axis=tuple(not_cond_var_index))
-			# make a new factor which is the same but divided by the normalization.
-			new_factor = Factor(names,array.shape)
-			for i in range(indexes.shape[0]):
-				norm = sums[tuple(indexes[i,cond_var_index])]
-				new_factor.set(indexes[i],array[tuple(indexes[i])]/norm)
-			return new_factor
+			np.divide(array,sums,out=out.array)
+	if(zero_policy=="uniform" and np.any(zero_sums)):
+		slice_size = np.prod([array.shape[b] for b in not_cond_var_index])
+		if(factor.log_space):
+			out.array[np.broadcast_to(zero_sums,array.shape)] = -np.log(slice_size)
+		else:
+			out.array[np.broadcast_to(zero_sums,array.shape)] = 1/slice_size
+	return out
 
 # 2. FACTOR MARGINALIZATION
 # 		returns a smaller factor, taking the expectation over all variables in axis
 def marginalize(factor,axis="none"):
 	array = factor.array
-	indexes = factor.indexes
 	names = factor.names
 	if(axis=="none" or len(axis)==len(factor.names)):
+		if(factor.log_space):
+			return logsumexp(array)
 		return np.sum(array)
 	else:
 		marg_var_index = [a for a in np.arange(len(names)) if names[a] in axis]
@@ -112,35 +174,49 @@ def marginalize(factor,axis="none"):
 		else:
 			# fairly simple, just sum out the variables in the axis list.
 			not_marg_var_index = [b for b in range(len(names)) if not b in marg_var_index]
-			summed_array = np.sum(array,axis=tuple(marg_var_index))
+			if(factor.log_space):
+				summed_array = logsumexp(array,axis=tuple(marg_var_index))
+			else:
+				summed_array = np.sum(array,axis=tuple(marg_var_index))
 			new_names = [names[n] for n in not_marg_var_index]
-			new_factor = Factor(new_names,summed_array.shape)
+			new_factor = Factor(new_names,summed_array.shape,factor.log_space)
 			new_factor.set_all(summed_array)
 			return new_factor
 
 # 3. FACTOR PRODUCT
 # 		returns a joined factor. Most complicated piece of code here. Book gives good visualization.
 #		for each variable in factor1 which is not also in factor2 it needs to go through every option in factor2.
+#		Rather than looping over every option, both arrays are lined up to the new variable order (size 1 axes
+#		where a factor doesn't have the variable) and numpy broadcasting does the multiplication in one go.
 
 def product(factor1,factor2):
-	names1 = factor1.names
-	names2 = factor2.names
+	if(factor1.log_space!=factor2.log_space):
+		raise Exception('one factor is in log space and the other is not. Use to_log_space or to_linear_space first')
+	names1 = list(factor1.names)
+	names2 = list(factor2.names)
 	# find variables both in factor 1 and 2
 	joint_names = [n for n in names1 if n in names2]
 	# get a list of all variables which will be in the new factor
 	new_names = names1 + [n for n in names2 if not n in joint_names]
-	from_2_to_new_index = [new_names.index(n) for n in names2]
-	factor2_not_joint_index = [n for n in range(len(names2)) if not names2[n] in joint_names]
-	# get the shape of the new array. Essentially adding new dimensions to factor1
-	new_shapes = list(factor1.array.shape)+[factor2.array.shape[n] for n in factor2_not_joint_index]
-	new_factor = Factor(new_names,new_shapes)
-	# every option in the new factor is the value in both factors with their respective variables multiplied.
-	for i in new_factor.indexes:
-		f1_part = i[:len(names1)]
-		f2_part = i[from_2_to_new_index]
-		new_factor.set(i,factor1.get(f1_part)*factor2.get(f2_part))
+	aligned_array1 = align_array(factor1,new_names)
+	aligned_array2 = align_array(factor2,new_names)
+	if(factor1.log_space):
+		new_array = aligned_array1+aligned_array2
+	else:
+		new_array = aligned_array1*aligned_array2
+	new_factor = Factor(new_names,new_array.shape,factor1.log_space)
+	new_factor.set_all(new_array)
 	return new_factor
 
+# moves the axes of a factor's array into the order given by names, adding a size 1 axis for every name the factor doesn't have.
+# The result broadcasts against any other array aligned to the same names.
+def align_array(factor,names):
+	factor_names = list(factor.names)
+	present = [n for n in names if n in factor_names]
+	transposed = np.transpose(factor.array,[factor_names.index(n) for n in present])
+	aligned_shape = [factor.array.shape[factor_names.index(n)] if n in factor_names else 1 for n in names]
+	return transposed.reshape(aligned_shape)
+
 # 4. DROP VARIABLES
 #		selects a variables at particular values. 
 #		E.g if the array is:
@@ -151,7 +227,6 @@ def product(factor1,factor2):
 
 def drop_variables(factor,axis,values):
 	array = factor.array
-	indexes = factor.indexes
 	names = factor.names
 	var_index = [a for a in np.arange(len(names)) if names[a] in axis]
 	if(len(var_index)<1):
@@ -165,7 +240,7 @@ def drop_variables(factor,axis,values):
 			slc[var_index[v_i]]=slice(values[axis.index(names[var_index[v_i]])],values[axis.index(names[var_index[v_i]])]+1)
 		sliced_array = np.squeeze(array[tuple(slc)])
 		new_names = [names[n] for n in not_var_index]
-		new_factor = Factor(new_names,sliced_array.shape)
+		new_factor = Factor(new_names,sliced_array.shape,factor.log_space)
 		new_factor.set_all(sliced_array) # squeeze removes all axes with 1 dim.
 		return new_factor
 
@@ -181,10 +256,13 @@ def multiple_factor_product(all_factors):
 # simple code to sample variables from the factor.
 def sample(factor,number_of_samples):
 	array = factor.array
-	indexes = factor.indexes
+	if(factor.log_space):
+		# only the relative sizes matter, so shift so the largest value is exp(0)=1 before leaving log space.
+		array = np.exp(array-np.max(array))
 	normalized_array = array/np.sum(array)
-	rows = np.random.choice(np.arange(indexes.shape[0]),number_of_samples,p=normalized_array.reshape(-1))
-	return indexes[rows]
+	rows = np.random.choice(np.arange(array.size),number_of_samples,p=normalized_array.reshape(-1))
+	# turn the flat positions back into one index per variable, only for the rows that were drawn.
+	return np.array(np.unravel_index(rows,array.shape)).T.reshape(number_of_samples,array.ndim)
 
 
 
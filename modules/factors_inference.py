@@ -1,6 +1,10 @@
 import factors
 import numpy as np
+import warnings
+import multiprocessing
+import time
 
+# Works with factors in log space too, their values are already logs so they are just added up.
 def get_log_likelihood(all_factors,known_vars,evidence):
 	prob = 0
 	for f in all_factors:
@@ -9,18 +13,94 @@ def get_log_likelihood(all_factors,known_vars,evidence):
 		if(len(f_unknown_vars)>0):
 			f_marg = factors.marginalize(f,f_unknown_vars)
 			if(not isinstance(f_marg,(int,float))):
-				prob+=np.log(f_marg.get(f_known_values))
+				prob+=get_log_value(f_marg,f_known_values)
 		else:
-			prob+=np.log(f.get(f_known_values))
+			prob+=get_log_value(f,f_known_values)
 	return prob
 
+def get_log_value(factor,index):
+	if(factor.log_space):
+		return factor.get(index)
+	return np.log(factor.get(index))
+
+# ELIMINATION ORDER
+# The order variables are eliminated in decides how big the intermediate tables get. Eliminating a variable multiplies
+# together every factor it is in, so the table covers the variable and all its current neighbours in the interaction
+# graph (variables are neighbours if they share a factor), and afterwards all those neighbours are connected.
+# This greedily picks the next variable to eliminate using one of the usual heuristics:
+#		"min_fill": fewest new edges added between its neighbours
+#		"min_degree": fewest neighbours
+#		"min_weight": smallest table (product of the neighbour's and its own number of values)
+# heuristic=None keeps the given order. Known variables are dropped from the scopes first, as in the elimination.
+# Returns the order and the predicted number of entries in the largest table made along the way (including the final
+# joint over the variables which aren't eliminated).
+
+def plan_elimination_order(all_factors,unknown_vars,known_vars=[],heuristic="min_fill"):
+	cardinalities,neighbours = interaction_graph(all_factors,known_vars)
+	
+	def fill_in(var):
+		var_neighbours = list(neighbours[var])
+		return sum([1 for i in range(len(var_neighbours)) for j in range(i) if not var_neighbours[j] in neighbours[var_neighbours[i]]])
+	
+	def table_size(var):
+		return int(np.prod([cardinalities[n] for n in neighbours[var]]))*cardinalities[var]
+	
+	scores = {"min_fill":fill_in,"min_degree":lambda var: len(neighbours[var]),"min_weight":table_size}
+	if(heuristic!=None and not heuristic in scores):
+		raise Exception('unknown heuristic {}. Use one of {}'.format(heuristic,list(scores.keys())))
+	remaining = [v for v in unknown_vars if v in neighbours]
+	order = []
+	largest_table = 0
+	while(len(remaining)>0):
+		if(heuristic==None):
+			var = remaining[0]
+		else:
+			# ties go to whichever came first in unknown_vars.
+			var_scores = [scores[heuristic](v) for v in remaining]
+			var = remaining[int(np.argmin(var_scores))]
+		largest_table = max(largest_table,table_size(var))
+		# connect up all the neighbours and take the variable out of the graph.
+		for n in neighbours[var]:
+			neighbours[n].update([m for m in neighbours[var] if m!=n])
+			neighbours[n].discard(var)
+		del neighbours[var]
+		remaining.remove(var)
+		order.append(var)
+	if(len(neighbours)>0):
+		largest_table = max(largest_table,int(np.prod([cardinalities[n] for n in neighbours])))
+	return order,largest_table
+
+# the number of values of each variable and the set of variables it shares a factor with.
+def interaction_graph(all_factors,known_vars=[]):
+	cardinalities = {}
+	neighbours = {}
+	for f in all_factors:
+		scope = [n for n in f.names if not n in known_vars]
+		for n,size in zip(f.names,f.array.shape):
+			if(n in scope):
+				cardinalities[n] = size
+				neighbours.setdefault(n,set()).update([m for m in scope if m!=n])
+	return cardinalities,neighbours
+
 # SUM PRODUCT
 # This runs the sum product algorithm for variable elimination. 
 # Every name in known_vars has a piece of evidence associated with it.
 # Every variable in unknown_vars is marginalized. Returns a joint distribution over what is left.
-# The order of unknown_vars is the order in which marginalization happens.
+# The order variables are marginalized in is picked by plan_elimination_order using heuristic,
+# heuristic=None marginalizes in the order of unknown_vars.
+# memory_budget (in bytes) is checked against the predicted largest table before anything is run,
+# going over it raises an error, or only warns if budget_action="warn".
+# If the factors are in log space the whole elimination happens in log space and the result is a log space factor.
 
-def sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_vars):
+def sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_vars,heuristic="min_fill",memory_budget=None,budget_action="raise"):
+	unknown_vars,largest_table = plan_elimination_order(all_factors,unknown_vars,known_vars,heuristic)
+	if(memory_budget!=None and largest_table*8>memory_budget):
+		message = 'the largest table in the elimination has {} entries ({} bytes) which is over the memory budget of {} bytes'.format(largest_table,largest_table*8,memory_budget)
+		if(budget_action=="warn"):
+			warnings.warn(message)
+		else:
+			raise Exception(message)
+	
 	# Step 1: condition by factor by setting each known variable to each piece of evidence
 	new_factors = []
 	for f in all_factors:
@@ -51,6 +131,171 @@ def sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_var
 	final_normalized_factor = factors.condition(final_combined_factor)
 	return final_normalized_factor
 
+# COMPILED VARIABLE ELIMINATION
+# When the same factors are asked the same kind of question over and over (same query and evidence variables, only the
+# evidence values change) all the bookkeeping in sum_product_variable_elimination comes out the same every time.
+# compile_variable_elimination does it once: picks the elimination order, works out which tables are multiplied at each
+# step as an einsum string and finds the einsum contraction path for it. Calling the result with the evidence values
+# then only does the numeric work, and returns the same normalized factor over query_vars (in that order).
+# e.g query = factors_inference.compile_variable_elimination(all_factors,["A","C"],["D"])
+#	  query([1])
+# The factor values are read when the plan is called, so the same plan works after the values of the factors change.
+# A different list of factors with the same names and shapes can also be passed in, e.g query([1],new_factors).
+# Log space factors are moved out of log space one factor at a time (shifted so their largest value is 1) and the result
+# is moved back into log space.
+
+# Each einsum step gets its own letters for the variables it touches, so the number of variables in the model isn't
+# limited by the 52 letters einsum has, only the number in one step (which would be far too big a table anyway).
+
+einsum_letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+class CompiledElimination:
+	def __init__(self,all_factors,query_vars,evidence_vars,heuristic="min_fill"):
+		cardinalities = {}
+		for f in all_factors:
+			for n,size in zip(f.names,f.array.shape):
+				cardinalities[n] = size
+		free_vars = [n for n in cardinalities if not n in evidence_vars]
+		missing = [n for n in query_vars if not n in free_vars]
+		if(len(missing)>0):
+			raise Exception('query variables {} are not in any factor or are also evidence'.format(missing))
+		unknown_vars = [n for n in free_vars if not n in query_vars]
+		order,largest_table = plan_elimination_order(all_factors,unknown_vars,evidence_vars,heuristic)
+		
+		# for each factor: move the evidence axes to the front so indexing them with the evidence leaves the other axes in order.
+		self.factor_transposes = []
+		self.factor_evidence = []
+		terms = []
+		for j,f in enumerate(all_factors):
+			names = list(f.names)
+			evidence_axes = [a for a in range(len(names)) if names[a] in evidence_vars]
+			free_axes = [a for a in range(len(names)) if not a in evidence_axes]
+			self.factor_transposes.append(evidence_axes+free_axes)
+			self.factor_evidence.append([list(evidence_vars).index(names[a]) for a in evidence_axes])
+			# factors with nothing but evidence in them only scale the answer, which gets normalized anyway.
+			if(len(free_axes)>0):
+				terms.append((("factor",j),[names[a] for a in free_axes]))
+		
+		# run the elimination on the scopes only, recording each step.
+		self.steps = []
+		for var in order:
+			combine = [t for t in terms if var in t[1]]
+			terms = [t for t in terms if not var in t[1]]
+			out_vars = sorted(set([n for t in combine for n in t[1]])-set([var]),key=free_vars.index)
+			self.steps.append(self.make_step(combine,out_vars,cardinalities))
+			terms.append((("step",len(self.steps)-1),out_vars))
+		self.steps.append(self.make_step(terms,list(query_vars),cardinalities))
+		
+		self.all_factors = all_factors
+		self.query_vars = list(query_vars)
+		self.evidence_vars = list(evidence_vars)
+		self.order = order
+		self.largest_table = largest_table
+		self.query_shape = [cardinalities[n] for n in query_vars]
+	
+	# one einsum call: where the inputs come from, the subscripts and the contraction path.
+	# inputs are (source,variable names) and out_vars the names of the result, letters are given out for this step only.
+	def make_step(self,inputs,out_vars,cardinalities):
+		step_vars = []
+		for source,names in inputs:
+			step_vars += [n for n in names if not n in step_vars]
+		step_vars += [n for n in out_vars if not n in step_vars]
+		if(len(step_vars)>len(einsum_letters)):
+			raise Exception('one elimination step has {} variables, einsum can only do {}'.format(len(step_vars),len(einsum_letters)))
+		symbol = dict(zip(step_vars,einsum_letters))
+		in_subscripts = ["".join([symbol[n] for n in t[1]]) for t in inputs]
+		out_subscript = "".join([symbol[n] for n in out_vars])
+		shapes = [[cardinalities[n] for n in t[1]] for t in inputs]
+		if(len(inputs)>1):
+			# einsum_path only looks at shapes, broadcast_to gives arrays of the right shape without allocating them.
+			subscripts = ",".join(in_subscripts)+"->"+out_subscript
+			path = np.einsum_path(subscripts,*[np.broadcast_to(np.empty(()),s) for s in shapes],optimize="greedy")[0]
+		else:
+			path = False
+		return [t[0] for t in inputs],in_subscripts,out_subscript,path
+	
+	# runs every step. In batched mode the evidence is a column per evidence variable and any array which was indexed
+	# with evidence has a leading batch axis, which einsum carries through as "..." so each row stays separate.
+	def run(self,evidence,all_factors,batched):
+		factor_arrays = []
+		for j,f in enumerate(all_factors):
+			array = f.array
+			if(f.log_space):
+				array = np.exp(array-np.max(array))
+			selected = tuple([evidence[e] for e in self.factor_evidence[j]])
+			factor_arrays.append((np.transpose(array,self.factor_transposes[j])[selected],batched and len(selected)>0))
+		step_arrays = []
+		for inputs,in_subscripts,out_subscript,path in self.steps:
+			operands = [factor_arrays[i] if source=="factor" else step_arrays[i] for source,i in inputs]
+			if(len(operands)==0):
+				step_arrays.append((np.ones(self.query_shape),False))
+				continue
+			has_batch = any([b for a,b in operands])
+			subscripts = ",".join([("..." if b else "")+sub for (a,b),sub in zip(operands,in_subscripts)])
+			subscripts += "->"+("..." if has_batch else "")+out_subscript
+			step_arrays.append((np.einsum(subscripts,*[a for a,b in operands],optimize=path),has_batch))
+		return step_arrays[-1]
+	
+	def __call__(self,evidence,all_factors=None):
+		if(all_factors==None):
+			all_factors = self.all_factors
+		result,has_batch = self.run(evidence,all_factors,False)
+		new_factor = factors.Factor(self.query_vars,self.query_shape)
+		new_factor.set_all(result)
+		new_factor = factors.condition(new_factor)
+		if(all_factors[0].log_space):
+			return factors.to_log_space(new_factor)
+		return new_factor
+	
+	# evidence_matrix is (N, number of evidence variables), one row of evidence values per query.
+	# Returns the query names and an (N, ...) array where row n is the normalized distribution for evidence row n.
+	def batch(self,evidence_matrix,all_factors=None):
+		if(all_factors==None):
+			all_factors = self.all_factors
+		evidence_matrix = np.atleast_2d(np.asarray(evidence_matrix).astype(int))
+		result,has_batch = self.run(list(evidence_matrix.T),all_factors,True)
+		if(not has_batch):
+			result = np.broadcast_to(result,[evidence_matrix.shape[0]]+self.query_shape)
+		query_axes = tuple(range(1,result.ndim))
+		with np.errstate(divide="ignore",invalid="ignore"):
+			result = result/np.sum(result,axis=query_axes,keepdims=True)
+			if(all_factors[0].log_space):
+				result = np.log(result)
+		return self.query_vars,result
+
+def compile_variable_elimination(all_factors,query_vars,evidence_vars,heuristic="min_fill"):
+	return CompiledElimination(all_factors,query_vars,evidence_vars,heuristic)
+
+# BATCHED INFERENCE
+# The same as sum_product_variable_elimination but for lots of evidence rows at once, evidence_matrix is (N, len(known_vars)).
+# Everything which isn't known or in unknown_vars is the query. Returns the query names and an (N, ...) array of posteriors.
+def batched_variable_elimination(all_factors,known_vars,evidence_matrix,unknown_vars,heuristic="min_fill"):
+	all_names = []
+	for f in all_factors:
+		all_names += [n for n in f.names if not n in all_names]
+	query_vars = [n for n in all_names if not n in known_vars and not n in unknown_vars]
+	plan = compile_variable_elimination(all_factors,query_vars,known_vars,heuristic)
+	return plan.batch(evidence_matrix)
+
+# get_log_likelihood for every row of an (N, len(known_vars)) evidence matrix, returns an (N,) array.
+def batched_log_likelihood(all_factors,known_vars,evidence_matrix):
+	evidence_matrix = np.atleast_2d(np.asarray(evidence_matrix).astype(int))
+	prob = np.zeros(evidence_matrix.shape[0])
+	for f in all_factors:
+		f_known_columns = [list(known_vars).index(name) for name in f.names if name in known_vars]
+		f_unknown_vars = [name for name in f.names if not name in known_vars]
+		if(len(f_unknown_vars)>0):
+			f = factors.marginalize(f,f_unknown_vars)
+			if(isinstance(f,(int,float))):
+				continue
+		values = f.array[tuple(evidence_matrix[:,f_known_columns].T)]
+		if(f.log_space):
+			prob += values
+		else:
+			with np.errstate(divide="ignore"):
+				prob += np.log(values)
+	return prob
+
 # Does variable elimination by constructing full factor
 def full_joint_elimination(all_factors,known_vars,evidence,unknown_vars):
 	full_joint_factor = factors.multiple_factor_product(all_factors)
@@ -63,39 +308,320 @@ def full_joint_elimination(all_factors,known_vars,evidence,unknown_vars):
 		normalized = factors.condition(set_vars)
 		return normalized
 
+# LOOPY BELIEF PROPAGATION
+# For graphs too wide for exact inference. Messages are passed between factors and variables over and over (flooding:
+# every message is updated from the previous round) until they stop changing. This is exact on trees and usually a good
+# approximation otherwise. Memory only ever holds the factors and one message per factor/variable pair, never a joint.
+# 		variable -> factor: product of the messages into the variable from every other factor
+# 		factor -> variable: the factor times the messages from its other variables, summed down to the variable
+# damping mixes in that much of the old factor -> variable message, which helps stop messages oscillating on loops.
+# Stops once no newly computed (undamped) message differs from the old one by more than tolerance, or after max_iterations (with a warning).
+# Returns the approximate marginal of every variable which isn't evidence, in the order they are first seen.
+
+def loopy_belief_propagation(all_factors,known_vars,evidence,max_iterations=100,tolerance=1e-6,damping=0.5):
+	reduced = []
+	for f in all_factors:
+		f = factors.drop_variables(f,known_vars,evidence)
+		if(f!=None):
+			array = f.array
+			if(f.log_space):
+				array = np.exp(array-np.max(array))
+			reduced.append((list(f.names),array))
+	cardinalities = {}
+	factors_of_var = {}
+	for j,(names,array) in enumerate(reduced):
+		for n,size in zip(names,array.shape):
+			cardinalities[n] = size
+			factors_of_var.setdefault(n,[]).append(j)
+	variables = list(cardinalities.keys())
+	
+	# every message starts uniform. For each factor and each of its variables, the einsum which sends that message.
+	factor_to_var = dict([((j,n),np.ones(cardinalities[n])/cardinalities[n]) for j,(names,array) in enumerate(reduced) for n in names])
+	var_to_factor = dict(factor_to_var)
+	subscripts = {}
+	for j,(names,array) in enumerate(reduced):
+		if(len(names)>len(einsum_letters)):
+			raise Exception('a factor has {} variables, einsum can only do {}'.format(len(names),len(einsum_letters)))
+		factor_letters = einsum_letters[:len(names)]
+		for a,n in enumerate(names):
+			subscripts[(j,n)] = factor_letters+"".join([","+factor_letters[b] for b in range(len(names)) if b!=a])+"->"+factor_letters[a]
+	
+	converged = False
+	for iteration in range(max_iterations):
+		# variable -> factor. Sum the logs of all the incoming messages from before and after each factor (cumulative sums
+		# from both ends), which leaves out exactly that factor's message without dividing.
+		for v in variables:
+			with np.errstate(divide="ignore"):
+				log_incoming = np.log(np.array([factor_to_var[(j,v)] for j in factors_of_var[v]]))
+			zeros = np.zeros((1,cardinalities[v]))
+			before = np.cumsum(np.vstack([zeros,log_incoming[:-1]]),axis=0)
+			after = np.cumsum(np.vstack([zeros,log_incoming[:0:-1]]),axis=0)[::-1]
+			log_outgoing = before+after
+			with np.errstate(invalid="ignore"):
+				outgoing = np.exp(log_outgoing-np.max(log_outgoing,axis=1,keepdims=True))
+			outgoing = outgoing/np.sum(outgoing,axis=1,keepdims=True)
+			for k,j in enumerate(factors_of_var[v]):
+				var_to_factor[(j,v)] = outgoing[k]
+		# factor -> variable
+		largest_change = 0
+		for j,(names,array) in enumerate(reduced):
+			for n in names:
+				others = [var_to_factor[(j,m)] for m in names if m!=n]
+				message = np.einsum(subscripts[(j,n)],array,*others)
+				message = message/np.sum(message)
+				# the change is measured before damping, which would otherwise shrink it by (1-damping).
+				largest_change = max(largest_change,np.max(np.abs(message-factor_to_var[(j,n)])))
+				factor_to_var[(j,n)] = damping*factor_to_var[(j,n)]+(1-damping)*message
+		if(largest_change<tolerance):
+			converged = True
+			break
+	if(not converged):
+		warnings.warn('loopy belief propagation did not converge in {} iterations'.format(max_iterations))
+	
+	marginals = []
+	for v in variables:
+		belief = np.prod(np.array([factor_to_var[(j,v)] for j in factors_of_var[v]]),axis=0)
+		marginal = factors.Factor([v],[cardinalities[v]])
+		marginal.set_all(belief/np.sum(belief))
+		marginals.append(marginal)
+	return marginals
+
 # Learns a directed model MLE parameters, using the EM algorithm.
-def learn_directed_PGM_EM(prior_factors,data_variable_names,data,iterations):
+# Rows of data which are exactly the same give exactly the same expected counts, so duplicates are collapsed into one row
+# with a count first. The rows are then grouped by which variables are missing: every row in a group needs the same
+# inference with different evidence, so each group gets one compiled elimination plan (kept between iterations) and
+# one batched call for all its rows. -1 in data means missing.
+# With processes set, the rows are split into that many shards and the E step runs on each shard in its own process,
+# the expected counts from the shards are then added up. Each process is given only its own shard, once when it starts,
+# so each iteration only sends the current factors.
+# Other options:
+#		tolerance: stop early once the log likelihood changes by less than this fraction of itself between iterations.
+#		pseudocounts: Dirichlet pseudocounts added to the expected counts before normalizing (MAP rather than MLE),
+#			either one number for every cell or a list with an array per factor the same shape as the factor.
+#		callback: called after every iteration with a dictionary of "iteration", "log_likelihood", "wall_time" (seconds
+#			since the start) and "e_step_time", "m_step_time" (seconds spent in each step this iteration).
+#			If it returns True the learning stops there.
+#		verbose: print the log likelihood every iteration.
+def learn_directed_PGM_EM(prior_factors,data_variable_names,data,iterations,processes=None,tolerance=None,pseudocounts=0,callback=None,verbose=True):
+	start_time = time.perf_counter()
 	old_factors = prior_factors
-	for iteration in range(iterations):
-		log_likelihood = 0
-		new_factors = [f.copy_zeros() for f in prior_factors]
-		for x in data:
-			known_names = [data_variable_names[v] for v in range(len(data_variable_names)) if x[v]!=-1]
-			known_evidence = x[x!=-1]
-			if(len(known_names)<len(data_variable_names)):
-				# E step: Infer the distribution over unknowns
-				infered_factor = sum_product_variable_elimination(old_factors,known_names,known_evidence,[])
-				# go through every possible option
-				for unknown_vector in infered_factor.indexes:
-					# get the full evidence vector, filling in the missing values.
-					infered_factor_to_sample_index_transform = [data_variable_names.index(v) for v in infered_factor.names]
-					full_evidence = x.copy()
-					full_evidence[infered_factor_to_sample_index_transform]=unknown_vector
-					probability = infered_factor.get(unknown_vector)
-					# For each factor update the counts at the given index.
-					for j in range(len(old_factors)):
-						# have to first make sure the indexing is the same as the order of variables can change. 
-						factor_to_sample_index_transform = [data_variable_names.index(name) for name in old_factors[j].names]
-						rearanged_index = full_evidence[factor_to_sample_index_transform]
-						old_value = new_factors[j].get(rearanged_index)
-						new_factors[j].set(rearanged_index,old_value+probability)
+	# counts are always kept as normal numbers, if the priors are in log space the learned factors are moved back at the end of each iteration.
+	log_space = prior_factors[0].log_space
+	groups = group_data_rows(data)
+	plans = {}
+	workers = []
+	if(processes!=None):
+		for s in range(processes):
+			shard = [(observed,rows[s::processes],row_counts[s::processes]) for observed,rows,row_counts in groups if len(rows[s::processes])>0]
+			connection,worker_connection = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=em_worker,args=(worker_connection,data_variable_names,shard),daemon=True)
+			process.start()
+			worker_connection.close()
+			workers.append((process,connection))
+	previous_log_likelihood = None
+	try:
+		for iteration in range(iterations):
+			# E step: expected counts for every factor
+			e_step_start = time.perf_counter()
+			if(len(workers)==0):
+				counts,log_likelihood = expected_counts(old_factors,data_variable_names,groups,plans)
 			else:
-				for j in range(len(old_factors)):
-					factor_to_sample_index_transform = [data_variable_names.index(name) for name in old_factors[j].names]
-					rearanged_index = known_evidence[factor_to_sample_index_transform]
-					old_value = new_factors[j].get(rearanged_index)
-					new_factors[j].set(rearanged_index,old_value+1)
-			log_likelihood += get_log_likelihood(old_factors,known_names,known_evidence)
-		print("log likelihood",log_likelihood)
-		old_factors = [factors.condition(f,axis=f.names[1:]) for f in new_factors]
+				for process,connection in workers:
+					connection.send(old_factors)
+				results = [connection.recv() for process,connection in workers]
+				for r in results:
+					if(isinstance(r,Exception)):
+						raise r
+				counts = [np.sum([r[0][j] for r in results],axis=0) for j in range(len(old_factors))]
+				log_likelihood = np.sum([r[1] for r in results])
+			if(verbose):
+				print("log likelihood",log_likelihood)
+			# M step: normalize the counts
+			m_step_start = time.perf_counter()
+			old_factors = counts_to_factors(prior_factors,counts,pseudocounts=pseudocounts)
+			if(log_space):
+				old_factors = [factors.to_log_space(f) for f in old_factors]
+			m_step_end = time.perf_counter()
+			if(callback!=None):
+				metrics = {"iteration":iteration,
+						   "log_likelihood":log_likelihood,
+						   "wall_time":m_step_end-start_time,
+						   "e_step_time":m_step_start-e_step_start,
+						   "m_step_time":m_step_end-m_step_start}
+				if(callback(metrics)==True):
+					break
+			if(tolerance!=None and previous_log_likelihood!=None):
+				if(abs(log_likelihood-previous_log_likelihood)<=tolerance*abs(previous_log_likelihood)):
+					break
+			previous_log_likelihood = log_likelihood
+	finally:
+		for process,connection in workers:
+			try:
+				connection.send(None)
+			except (BrokenPipeError,OSError):
+				pass
+			connection.close()
+			process.join()
 	return old_factors
+
+# Each worker process holds one shard and its own compiled plans. It runs the E step on its shard for every set of
+# factors it is sent, until it is sent None. An error is sent back rather than raised, so the main process can raise it.
+def em_worker(connection,data_variable_names,shard):
+	plans = {}
+	while(True):
+		current_factors = connection.recv()
+		if(current_factors is None):
+			break
+		try:
+			result = expected_counts(current_factors,data_variable_names,shard,plans)
+		except Exception as e:
+			result = e
+		connection.send(result)
+	connection.close()
+
+# ONLINE (STEPWISE) EM
+# For data too big to go through every iteration, or to hold in memory at all. batches is anything which gives data
+# arrays one at a time (a list, a generator, NpyBatches). After the E step on each batch, the running
+# expected counts (per row) move part of the way towards the batch's:
+#		counts = (1-step)*counts + step*batch_counts/rows in batch,	step = (k+step_offset)^-step_decay for the k-th batch
+# and the factors are re-estimated from the running counts straight away. step_decay between 0.5 and 1 is needed for this
+# to converge, smaller values forget old batches faster. epochs goes over batches that many times (so it has to be
+# something which can be iterated again, like a list or NpyBatches).
+# Parent combinations which haven't been seen yet are given a uniform distribution rather than nan.
+# callback works as in learn_directed_PGM_EM, called after every batch ("iteration" counts batches, the log likelihood
+# is the batch's under the factors from before the batch).
+def learn_directed_PGM_online_EM(prior_factors,data_variable_names,batches,step_decay=0.7,step_offset=2,epochs=1,callback=None):
+	start_time = time.perf_counter()
+	old_factors = prior_factors
+	log_space = prior_factors[0].log_space
+	running_counts = None
+	plans = {}
+	k = 0
+	for epoch in range(epochs):
+		for batch in batches:
+			batch = np.asarray(batch)
+			if(batch.shape[0]==0):
+				continue
+			e_step_start = time.perf_counter()
+			counts,log_likelihood = expected_counts(old_factors,data_variable_names,group_data_rows(batch),plans)
+			counts = [c/batch.shape[0] for c in counts]
+			m_step_start = time.perf_counter()
+			if(running_counts==None):
+				running_counts = counts
+			else:
+				step = (k+step_offset)**(-step_decay)
+				running_counts = [(1-step)*r+step*c for r,c in zip(running_counts,counts)]
+			old_factors = counts_to_factors(prior_factors,running_counts,zero_policy="uniform")
+			if(log_space):
+				old_factors = [factors.to_log_space(f) for f in old_factors]
+			m_step_end = time.perf_counter()
+			if(callback!=None):
+				metrics = {"iteration":k,
+						   "log_likelihood":log_likelihood,
+						   "wall_time":m_step_end-start_time,
+						   "e_step_time":m_step_start-e_step_start,
+						   "m_step_time":m_step_end-m_step_start}
+				if(callback(metrics)==True):
+					return old_factors
+			k += 1
+	return old_factors
+
+# Gives batch_size rows at a time from a .npy file without loading the whole file (it is memory mapped).
+# This is an object rather than a generator so it can be gone through more than once (for epochs>1).
+class NpyBatches:
+	def __init__(self,path,batch_size):
+		self.path = path
+		self.batch_size = batch_size
+	
+	def __iter__(self):
+		data = np.load(self.path,mmap_mode="r")
+		for start in range(0,data.shape[0],self.batch_size):
+			yield np.array(data[start:start+self.batch_size])
+
+# collapses duplicate rows and groups them by which variables are observed.
+# Returns a list of (observed pattern, the unique rows with that pattern, how many times each row appeared).
+def group_data_rows(data):
+	unique_rows,row_counts = np.unique(np.asarray(data).astype(int),axis=0,return_counts=True)
+	observed = unique_rows!=-1
+	patterns,pattern_of_row = np.unique(observed,axis=0,return_inverse=True)
+	pattern_of_row = pattern_of_row.reshape(-1)
+	return [(patterns[p],unique_rows[pattern_of_row==p],row_counts[pattern_of_row==p]) for p in range(len(patterns))]
+
+# The E step. For each group, the posterior over the missing variables for every row is worked out in one batch, weighted
+# by the row counts, summed down to each factor's missing variables and added into the factor's counts at the observed
+# values with np.add.at (which adds properly when the same cell comes up more than once).
+# plans is a dictionary of compiled eliminations by observed pattern, filled in as they are needed.
+# Returns one array of expected counts per factor and the log likelihood of the data.
+def expected_counts(current_factors,data_variable_names,groups,plans):
+	counts = [np.zeros(f.array.shape) for f in current_factors]
+	all_names = []
+	for f in current_factors:
+		all_names += [n for n in f.names if not n in all_names]
+	log_likelihood = 0
+	for observed,rows,row_counts in groups:
+		known_names = [data_variable_names[v] for v in range(len(data_variable_names)) if observed[v]]
+		missing_names = [n for n in all_names if not n in known_names]
+		evidence = rows[:,observed]
+		if(len(missing_names)>0):
+			key = tuple(observed)
+			if(not key in plans):
+				plans[key] = compile_variable_elimination(current_factors,missing_names,known_names)
+			names,posterior = plans[key].batch(evidence,current_factors)
+			if(current_factors[0].log_space):
+				posterior = np.exp(posterior)
+		else:
+			names,posterior = [],np.ones(len(rows))
+		posterior = posterior*row_counts.reshape([-1]+[1]*len(names))
+		for j,f in enumerate(current_factors):
+			f_known = [n for n in f.names if n in known_names]
+			f_missing = [n for n in f.names if not n in known_names]
+			# the posterior over just this factor's missing variables, in the order they are in the factor.
+			f_posterior = np.sum(posterior,axis=tuple([1+a for a in range(len(names)) if not names[a] in f_missing]))
+			kept = [n for n in names if n in f_missing]
+			f_posterior = np.transpose(f_posterior,[0]+[1+kept.index(n) for n in f_missing])
+			# a view of the counts with the known variables first, so indexing them with the evidence lines up with f_posterior.
+			count_view = np.transpose(counts[j],[list(f.names).index(n) for n in f_known+f_missing])
+			if(len(f_known)>0):
+				np.add.at(count_view,tuple(evidence[:,[known_names.index(n) for n in f_known]].T),f_posterior)
+			else:
+				count_view += np.sum(f_posterior,axis=0)
+		log_likelihood += np.sum(row_counts*batched_log_likelihood(current_factors,known_names,evidence))
+	return counts,log_likelihood
+
+# The M step, makes factors like the templates from the counts and conditions each on its parents (all but the first variable).
+# pseudocounts is one number added to every cell, or a list of arrays (one per factor) added to the counts.
+def counts_to_factors(factor_templates,counts,zero_policy="nan",pseudocounts=0):
+	new_factors = []
+	for j,(f,c) in enumerate(zip(factor_templates,counts)):
+		if(isinstance(pseudocounts,(list,tuple))):
+			c = c+pseudocounts[j]
+		else:
+			c = c+pseudocounts
+		new_factor = factors.Factor(f.names,list(f.array.shape))
+		new_factor.set_all(c)
+		new_factors.append(factors.condition(new_factor,axis=f.names[1:],zero_policy=zero_policy,out=new_factor))
+	return new_factors
+
+# COMPLETE DATA FITTING
+# When nothing is missing the E step isn't needed, the counts can be read straight off the data. Each row's values for a
+# factor's variables are turned into one flat position in the factor's array (np.ravel_multi_index) and np.bincount
+# counts every position in one pass, so there is no loop over rows.
+# prior is Dirichlet pseudocounts as in counts_to_factors: one number for every cell, or a list of arrays (one per factor).
+# With a prior the factors are the posterior mean (counts+pseudocounts normalized), prior=0 gives the MLE.
+# Rows missing (-1) any of a factor's variables are left out of that factor's counts only.
+# e.g new_factors = factors_inference.fit_counts(prior_factors,sample_variable_names,samples,prior=1)
+def fit_counts(factor_templates,data_variable_names,data,prior=0,zero_policy="nan"):
+	data = np.asarray(data)
+	counts = [count_family(f.names,f.array.shape,data_variable_names,data) for f in factor_templates]
+	new_factors = counts_to_factors(factor_templates,counts,zero_policy=zero_policy,pseudocounts=prior)
+	if(len(factor_templates)>0 and factor_templates[0].log_space):
+		new_factors = [factors.to_log_space(f) for f in new_factors]
+	return new_factors
+
+# how many rows of data have each combination of values of the variables in names, as an array with the given shape.
+def count_family(names,shape,data_variable_names,data):
+	columns = data[:,[data_variable_names.index(n) for n in names]]
+	if(np.any(columns<0)):
+		columns = columns[np.all(columns>=0,axis=1)]
+	flat = np.ravel_multi_index(columns.T,shape)
+	return np.bincount(flat,minlength=int(np.prod(shape))).reshape(shape).astype(float)
@@ -0,0 +1,189 @@
+import factors
+import factors_inference
+import numpy as np
+
+# JUNCTION TREE (CLIQUE TREE)
+# Variable elimination starts from scratch for every question. A junction tree does the work once so that the marginal
+# of every variable (or of any set of variables sitting together in one clique) can be read off afterwards.
+# 1. Triangulate: eliminate every variable (order from factors_inference.plan_elimination_order). Each elimination
+#		makes a clique out of the variable and its neighbours at that point. Cliques inside bigger cliques are dropped.
+# 2. Connect the cliques into a tree, joining the pairs which share the most variables first (maximum spanning tree).
+#		This keeps the running intersection property, so the tree agrees with itself once it is calibrated.
+# 3. Every factor is multiplied into one clique which contains all its variables.
+# 4. Messages are passed up to a root and back down again (two passes). The message from clique i to clique j is i's
+#		factor times every message into i except the one from j, summed down to the variables i and j share.
+#		A clique's belief is its factor times all its incoming messages, which is proportional to the joint over its variables.
+# Evidence is multiplied into a clique which contains the variable (its "home" clique) as a factor which is 1 at the
+# observed value and 0 elsewhere. Changing the evidence on a variable only changes messages sent away from its home
+# clique, so only those are thrown away and recomputed, the rest are kept.
+# e.g tree = factors_junction_tree.JunctionTree(all_factors)
+#	  tree.set_evidence(["D"],[1])
+#	  print(tree.marginal("A"))
+# Log space factors are moved out of log space when the tree is built. Messages are normalized as they are passed,
+# which stops them getting tiny, and doesn't change the normalized beliefs.
+
+class JunctionTree:
+	def __init__(self,all_factors,heuristic="min_fill"):
+		all_factors = [factors.to_linear_space(f) if f.log_space else f for f in all_factors]
+		cardinalities,neighbours = factors_inference.interaction_graph(all_factors)
+		order,largest_table = factors_inference.plan_elimination_order(all_factors,list(cardinalities.keys()),[],heuristic)
+
+		# 1. triangulate by running the elimination on the graph and keeping the clique made at each step.
+		cliques = []
+		for var in order:
+			clique = set(neighbours[var])|set([var])
+			for n in neighbours[var]:
+				neighbours[n].update([m for m in neighbours[var] if m!=n])
+				neighbours[n].discard(var)
+			del neighbours[var]
+			if(not any([clique<=c for c in cliques])):
+				cliques = [c for c in cliques if not c<=clique]+[clique]
+		# keep the variables in each clique in the order they were first seen, so factors print in a familiar order.
+		variable_order = list(cardinalities.keys())
+		self.cliques = [sorted(c,key=variable_order.index) for c in cliques]
+
+		# 2. maximum spanning tree on the number of shared variables (Kruskal, joining the biggest separators first).
+		candidate_edges = [(len(cliques[i]&cliques[j]),i,j) for i in range(len(cliques)) for j in range(i)]
+		candidate_edges.sort(key=lambda e: -e[0])
+		tree_of = list(range(len(cliques)))
+		def find_tree(i):
+			while(tree_of[i]!=i):
+				i = tree_of[i]
+			return i
+		self.neighbours = [[] for c in cliques]
+		for size,i,j in candidate_edges:
+			if(find_tree(i)!=find_tree(j)):
+				tree_of[find_tree(i)] = find_tree(j)
+				self.neighbours[i].append(j)
+				self.neighbours[j].append(i)
+
+		# for each directed edge i->j, which cliques are on i's side. Evidence in any of them changes the message i->j.
+		self.upstream = {}
+		for i in range(len(cliques)):
+			for j in self.neighbours[i]:
+				self.upstream[(i,j)] = self.reachable(i,j)
+
+		# 3. give each factor to the smallest clique which holds all of its variables.
+		self.potentials = []
+		for clique in self.cliques:
+			ones = factors.Factor(clique,[cardinalities[n] for n in clique])
+			ones.set_all(np.ones(ones.array.shape))
+			self.potentials.append(ones)
+		for f in all_factors:
+			homes = [c for c in range(len(cliques)) if set(f.names)<=cliques[c]]
+			home = min(homes,key=lambda c: self.potentials[c].array.size)
+			self.potentials[home] = factors.product(self.potentials[home],f)
+		self.home_clique = dict([(n,min([c for c in range(len(cliques)) if n in cliques[c]],key=lambda c: self.potentials[c].array.size)) for n in cardinalities])
+
+		self.cardinalities = cardinalities
+		self.order = order
+		self.largest_table = largest_table
+		self.evidence = {}
+		self.messages = {}
+		self.beliefs = {}
+
+	# the cliques which can be reached from start without going through blocked.
+	def reachable(self,start,blocked):
+		seen = set([start])
+		to_visit = [start]
+		while(len(to_visit)>0):
+			c = to_visit.pop()
+			for n in self.neighbours[c]:
+				if(n!=blocked and not n in seen):
+					seen.add(n)
+					to_visit.append(n)
+		return seen
+
+	# sets the observed value of each variable in known_vars. Variables which were observed before and aren't in
+	# known_vars keep their old value, use clear_evidence to remove them.
+	def set_evidence(self,known_vars,evidence):
+		changed = [n for n,v in zip(known_vars,evidence) if self.evidence.get(n)!=v]
+		for n,v in zip(known_vars,evidence):
+			self.evidence[n] = v
+		self.invalidate(changed)
+
+	def clear_evidence(self,known_vars=None):
+		if(known_vars is None):
+			known_vars = list(self.evidence.keys())
+		changed = [n for n in known_vars if n in self.evidence]
+		for n in changed:
+			del self.evidence[n]
+		self.invalidate(changed)
+
+	# throws away the messages and beliefs which depend on evidence for the given variables.
+	def invalidate(self,changed_vars):
+		changed_cliques = set([self.home_clique[n] for n in changed_vars])
+		if(len(changed_cliques)==0):
+			return
+		for edge in list(self.messages.keys()):
+			if(len(self.upstream[edge]&changed_cliques)>0):
+				del self.messages[edge]
+		self.beliefs = {}
+
+	# a clique's factor with the evidence for its home variables multiplied in.
+	def clique_factor(self,c):
+		potential = self.potentials[c]
+		for n,v in self.evidence.items():
+			if(self.home_clique[n]==c):
+				indicator = factors.Factor([n],[self.cardinalities[n]])
+				indicator.set([v],1)
+				potential = factors.product(potential,indicator)
+		return potential
+
+	# cliques with no variables in common (separate parts of the graph) send None, which is left out of the products.
+	def message(self,i,j):
+		if(not (i,j) in self.messages):
+			not_shared = [n for n in self.cliques[i] if not n in self.cliques[j]]
+			if(len(not_shared)==len(self.cliques[i])):
+				self.messages[(i,j)] = None
+			else:
+				incoming = [self.clique_factor(i)]+[self.message(k,i) for k in self.neighbours[i] if k!=j]
+				combined = factors.multiple_factor_product([m for m in incoming if m!=None])
+				if(len(not_shared)>0):
+					combined = factors.marginalize(combined,not_shared)
+				self.messages[(i,j)] = factors.condition(combined)
+		return self.messages[(i,j)]
+
+	# 4. two passes over the tree from clique 0: first every message towards the root, then every message away from it.
+	# Messages which are still valid from before are reused.
+	def calibrate(self):
+		parent = {0:None}
+		visit_order = [0]
+		for c in visit_order:
+			for n in self.neighbours[c]:
+				if(not n in parent):
+					parent[n] = c
+					visit_order.append(n)
+		for c in visit_order[::-1]:
+			if(parent[c]!=None):
+				self.message(c,parent[c])
+		for c in visit_order:
+			if(parent[c]!=None):
+				self.message(parent[c],c)
+
+	# the normalized joint over the variables of clique c given the evidence.
+	def belief(self,c):
+		if(not c in self.beliefs):
+			self.calibrate()
+			incoming = [self.clique_factor(c)]+[self.message(k,c) for k in self.neighbours[c]]
+			self.beliefs[c] = factors.condition(factors.multiple_factor_product([m for m in incoming if m!=None]))
+		return self.beliefs[c]
+
+	# the distribution over a set of variables which are all in one clique, e.g tree.clique_marginal(["A","C"]).
+	def clique_marginal(self,query_vars):
+		homes = [c for c in range(len(self.cliques)) if set(query_vars)<=set(self.cliques[c])]
+		if(len(homes)==0):
+			raise Exception('no clique contains all of {}, use variable elimination instead'.format(query_vars))
+		c = min(homes,key=lambda c: self.potentials[c].array.size)
+		belief = self.belief(c)
+		others = [n for n in belief.names if not n in query_vars]
+		if(len(others)>0):
+			belief = factors.marginalize(belief,others)
+		return belief
+
+	def marginal(self,var):
+		return self.clique_marginal([var])
+
+	# every variable's marginal, in the order the variables were first seen in the factors.
+	def marginals(self):
+		return [self.marginal(n) for n in self.cardinalities]
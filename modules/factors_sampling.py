@@ -1,5 +1,8 @@
 import factors
 import numpy as np
+import copy
+import multiprocessing
+from multiprocessing import shared_memory
 
 # Samples by setting the variables in order from top to bottom. Requires a directed factor graph. This is probably not going to work for an undirected graph.
 def joint_sample_top_down(all_factors):
@@ -24,11 +27,131 @@ def joint_sample_top_down(all_factors):
         remaining_factors = new_remaining_factors
     return assigned_variable_names,variable_assignments
 
+# Batched version of joint_sample_top_down. The order the variables get sampled in is worked out once, and each factor
+# is stored as a table of cumulative probabilities with one row per combination of its parents (its other variables).
+# Sampling a variable for all N samples at once is then a lookup of each sample's row from the parent values already
+# drawn, and a comparison against a uniform number (inverse CDF).
+# e.g sampler = factors_sampling.AncestralSampler(all_factors)
+#	  samples = sampler.sample(100000) # (100000, number of variables), columns in the order of sampler.names
+# rng is anything with a random(size) method, e.g np.random (the default) or np.random.default_rng(seed).
+class AncestralSampler:
+    def __init__(self,all_factors,rng=np.random):
+        # same order as joint_sample_top_down: in rounds, each round takes every factor whose parents are all assigned.
+        ordered_factors = []
+        names = []
+        remaining_factors = list(all_factors)
+        while(len(remaining_factors)>0):
+            ready = [f for f in remaining_factors if all([n in names for n in f.names[1:]])]
+            if(len(ready)==0):
+                raise Exception('could not find an order to sample in, the factors need to be directed with the variable first')
+            ordered_factors += ready
+            names += [f.names[0] for f in ready]
+            remaining_factors = [f for f in remaining_factors if not f in ready]
+        
+        self.names = names
+        self.rng = rng
+        self.parent_columns = []
+        self.parent_strides = []
+        self.cdf_tables = []
+        self.log_tables = []
+        for f in ordered_factors:
+            parents = list(f.names[1:])
+            # move the variable's axis last so each row is the distribution for one combination of parents.
+            array = np.moveaxis(f.array,0,-1).reshape(-1,f.array.shape[0])
+            if(f.log_space):
+                array = np.exp(array-np.max(array,axis=1,keepdims=True))
+            sums = np.sum(array,axis=1,keepdims=True)
+            with np.errstate(divide="ignore",invalid="ignore"):
+                array = np.where(sums>0,array/sums,1/f.array.shape[0])
+            parent_sizes = np.array(f.array.shape[1:]).astype(int)
+            self.parent_columns.append([names.index(n) for n in parents])
+            self.parent_strides.append(np.array([np.prod(parent_sizes[j+1:]) for j in range(len(parent_sizes))],dtype=int))
+            self.cdf_tables.append(np.cumsum(array,axis=1))
+            with np.errstate(divide="ignore"):
+                self.log_tables.append(np.log(array))
+        self.cardinalities = [table.shape[1] for table in self.cdf_tables]
+    
+    # the row of the table for variable k for every sample, from the parent values already in samples.
+    def rows(self,k,samples):
+        return samples[:,self.parent_columns[k]].dot(self.parent_strides[k])
+    
+    def draw(self,k,rows):
+        cdf = self.cdf_tables[k][rows]
+        uniforms = self.rng.random((len(rows),1))
+        return np.minimum(np.sum(cdf<=uniforms,axis=1),cdf.shape[1]-1)
+    
+    def sample(self,N):
+        samples = np.zeros((N,len(self.names))).astype(int)
+        for k in range(len(self.names)):
+            samples[:,k] = self.draw(k,self.rows(k,samples))
+        return samples
+    
+    # Batched likelihood weighting. Observed variables are set to their evidence instead of sampled, and each sample's
+    # log weight gets the log probability of the evidence given the sample's parents. Returns the (N, number of variables)
+    # samples and the (N,) log weights.
+    def likelihood_weighting(self,N,known_vars,evidence):
+        samples = np.zeros((N,len(self.names))).astype(int)
+        log_weights = np.zeros(N)
+        for k,name in enumerate(self.names):
+            rows = self.rows(k,samples)
+            if(name in known_vars):
+                value = evidence[list(known_vars).index(name)]
+                samples[:,k] = value
+                log_weights += self.log_tables[k][rows,value]
+            else:
+                samples[:,k] = self.draw(k,rows)
+        return samples,log_weights
+    
+    # keeps drawing batches of likelihood weighted samples until the effective sample size reaches target_ess
+    # (or max_samples have been drawn). Returns all the samples and log weights.
+    def likelihood_weighting_until_ess(self,known_vars,evidence,target_ess,batch_size=10000,max_samples=10000000):
+        all_samples = []
+        all_log_weights = []
+        total = 0
+        while(total<max_samples):
+            samples,log_weights = self.likelihood_weighting(min(batch_size,max_samples-total),known_vars,evidence)
+            all_samples.append(samples)
+            all_log_weights.append(log_weights)
+            total += samples.shape[0]
+            if(effective_sample_size(np.concatenate(all_log_weights))>=target_ess):
+                break
+        return np.concatenate(all_samples),np.concatenate(all_log_weights)
+    
+    # the weighted estimate of the distribution over query_vars, as a factor.
+    def weighted_posterior(self,samples,log_weights,query_vars):
+        columns = [self.names.index(n) for n in query_vars]
+        sizes = [self.cardinalities[c] for c in columns]
+        weights = np.exp(log_weights-np.max(log_weights))
+        flat = np.ravel_multi_index(tuple(samples[:,columns].T),sizes)
+        posterior = factors.Factor(list(query_vars),sizes)
+        posterior.set_all(np.bincount(flat,weights=weights,minlength=int(np.prod(sizes))))
+        return factors.condition(posterior)
+
+# How many unweighted samples the weighted samples are worth: (sum of weights)^2 / (sum of squared weights).
+def effective_sample_size(log_weights):
+    weights = np.exp(log_weights-np.max(log_weights))
+    return np.sum(weights)**2/np.sum(weights**2)
+
+# Returns the variable names, an (N, number of variables) array of samples and an (N,) array of log weights.
+def likelihood_weighting_batch(all_factors,known_vars,evidence,N):
+    sampler = AncestralSampler(all_factors)
+    samples,log_weights = sampler.likelihood_weighting(N,known_vars,evidence)
+    return sampler.names,samples,log_weights
+
+# Returns the variable names and an (N, number of variables) array of joint samples.
+def joint_sample_top_down_batch(all_factors,N):
+    sampler = AncestralSampler(all_factors)
+    return sampler.names,sampler.sample(N)
+
 # Likelihood weighted sampling. For normalized importance sampling to pgms. Similar to above but sets all observed variables and returns weight.
-def likelihood_weighting_top_down(all_factors,known_vars,evidence):
+# With log_weight=True the weight is built up as a sum of log probabilities instead, which doesn't underflow with lots of evidence.
+def likelihood_weighting_top_down(all_factors,known_vars,evidence,log_weight=False):
     assigned_variable_names = []
     variable_assignments = []
-    weight = 1
+    if(log_weight):
+        weight = 0
+    else:
+        weight = 1
     remaining_factors = all_factors.copy()
     
     while(len(remaining_factors)>0):
@@ -42,7 +165,15 @@ def likelihood_weighting_top_down(all_factors,known_vars,evidence):
                 if(f.names[0] in known_vars):
                     evid = evidence[known_vars.index(f.names[0])]
                     new_variable_assignments.append(evid)
-                    weight *= conditioned_factor.get([evid])
+                    prob = conditioned_factor.get([evid])
+                    if(log_weight and conditioned_factor.log_space):
+                        weight += prob
+                    elif(log_weight):
+                        weight += np.log(prob)
+                    elif(conditioned_factor.log_space):
+                        weight *= np.exp(prob)
+                    else:
+                        weight *= prob
                 else:
                     sample = factors.sample(conditioned_factor,1)[0][0]
                     new_variable_assignments.append(sample)
@@ -63,8 +194,6 @@ def gibbs_step(all_variable_markov_blankets,fixed_variables,all_variable_names,c
         if(not var_name in fixed_variables):
             joint = all_variable_markov_blankets[all_variable_names.index(var_name)]
             index = all_variable_names.index(var_name)
-            other_var_names = list(all_variable_names[:index])+list(all_variable_names[(index+1):])
-            other_var_vals = list(current_state_values[:index])+list(current_state_values[(index+1):])
             slc = [slice(None)]*len(joint.names)
             for i in range(len(all_variable_names)):
                 if(all_variable_names[i] in joint.names):
@@ -72,11 +201,11 @@ def gibbs_step(all_variable_markov_blankets,fixed_variables,all_variable_names,c
             joint_index = joint.names.index(var_name)
             slc[joint_index]=slice(0,joint.array.shape[joint_index])
             array_slice = np.squeeze(joint.array[tuple(slc)])
+            if(joint.log_space):
+                array_slice = np.exp(array_slice-np.max(array_slice))
             norm_array_slice = array_slice/np.sum(array_slice)
-            cond_joint = factors.drop_variables(joint,other_var_names,other_var_vals)
             sample = np.random.choice(np.arange(joint.array.shape[joint_index]),1,p=norm_array_slice)
-            #print(sample)
-            current_state_values[index]=sample
+            current_state_values[index]=sample[0]
     return current_state_values
 
 # Gibbs sampling begins by making a random vector of values and then applies the gibbs step repeatedly. 
@@ -106,9 +235,271 @@ def gibbs_sampling(all_factors,known_vars,evidence,N):
         all_variable_markov_blankets.append(factors.multiple_factor_product(markov_blanket))
     
     # This is the core loop
-    all_visited_states = []
+    all_visited_states = np.zeros((N,len(all_names))).astype(int)
     for n in range(N):
         current_state = gibbs_step(all_variable_markov_blankets,known_vars,all_names,current_state)
-        all_visited_states.append(current_state.copy())
-    return all_names,np.array(all_visited_states)
+        all_visited_states[n] = current_state
+    return all_names,all_visited_states
+
+# Vectorized Gibbs sampling. The same idea as above, but everything which doesn't change between sweeps is worked out once:
+# for each variable the markov blanket factor is turned into a table of cumulative probabilities with one row for every
+# combination of the other variables in the blanket, and the variable's values along the row. A sweep then only has to
+# find the row from the current state (a dot product with the row strides) and compare a uniform number against it
+# (inverse CDF), which is done for many independent chains at once, one chain per row of the state matrix.
+# Uniform numbers are drawn in big blocks rather than one at a time.
+# rng is anything with a random(size) method, e.g np.random (the default) or np.random.default_rng(seed).
+class GibbsSampler:
+    def __init__(self,all_factors,known_vars,evidence,rng=np.random):
+        all_names = []
+        for f in all_factors:
+            all_names+=list(f.names)
+        self.names = list(np.unique(all_names))
+        self.cardinalities = np.zeros(len(self.names)).astype(int)
+        for f in all_factors:
+            for name,size in zip(f.names,f.array.shape):
+                self.cardinalities[self.names.index(name)] = size
+        self.known_indexes = [self.names.index(name) for name in known_vars]
+        self.evidence = list(evidence)
+        self.rng = rng
+        
+        self.free_indexes = []
+        self.blanket_indexes = []
+        self.blanket_strides = []
+        self.cdf_tables = []
+        for i,var_name in enumerate(self.names):
+            if(var_name in known_vars):
+                continue
+            markov_blanket = factors.multiple_factor_product([f for f in all_factors if var_name in f.names])
+            others = [n for n in markov_blanket.names if n!=var_name]
+            # put the variable's own axis last, so each row of the flattened table is one conditional distribution.
+            order = [markov_blanket.names.index(n) for n in others]+[markov_blanket.names.index(var_name)]
+            array = np.transpose(markov_blanket.array,order).reshape(-1,self.cardinalities[i])
+            if(markov_blanket.log_space):
+                array = np.exp(array-np.max(array,axis=1,keepdims=True))
+            sums = np.sum(array,axis=1,keepdims=True)
+            # states which can't happen get a uniform row, they are never looked up unless a chain starts in one.
+            with np.errstate(divide="ignore",invalid="ignore"):
+                array = np.where(sums>0,array/sums,1/self.cardinalities[i])
+            other_indexes = [self.names.index(n) for n in others]
+            other_sizes = self.cardinalities[other_indexes]
+            self.free_indexes.append(i)
+            self.blanket_indexes.append(other_indexes)
+            self.blanket_strides.append(np.array([np.prod(other_sizes[j+1:]) for j in range(len(other_sizes))],dtype=int))
+            self.cdf_tables.append(np.cumsum(array,axis=1))
+    
+    # a random starting state for each chain, with the evidence set.
+    def initial_states(self,chains):
+        states = np.floor(self.rng.random((chains,len(self.names)))*self.cardinalities).astype(int)
+        states[:,self.known_indexes] = self.evidence
+        return states
+    
+    # one sweep over every free variable for every chain. uniforms is (chains, number of free variables).
+    def sweep(self,states,uniforms):
+        for k in range(len(self.free_indexes)):
+            rows = states[:,self.blanket_indexes[k]].dot(self.blanket_strides[k])
+            cdf = self.cdf_tables[k][rows]
+            new_values = np.sum(cdf<=uniforms[:,k:k+1],axis=1)
+            states[:,self.free_indexes[k]] = np.minimum(new_values,cdf.shape[1]-1)
+        return states
     
+    # runs N*thin sweeps and returns a (chains, N, number of variables) array of the states after every thin sweeps.
+    # Chains carry on from where the last run stopped, pass states to start somewhere else.
+    def run(self,N,chains=1,states=None,thin=1):
+        if(states is None):
+            states = getattr(self,"states",None)
+            if(states is None or states.shape[0]!=chains):
+                states = self.initial_states(chains)
+        samples = np.zeros((chains,N,len(self.names))).astype(int)
+        total_sweeps = N*thin
+        block_size = max(1,2**20//max(1,chains*len(self.free_indexes)))
+        for start in range(0,total_sweeps,block_size):
+            block = self.rng.random((min(block_size,total_sweeps-start),chains,len(self.free_indexes)))
+            for n in range(block.shape[0]):
+                states = self.sweep(states,block[n])
+                if((start+n+1)%thin==0):
+                    samples[:,(start+n+1)//thin-1] = states
+        self.states = states
+        return samples
+    
+    # STREAMING: a generator of (chains, block_size, number of variables) blocks of samples, so long runs keep a fixed
+    # amount of memory and results can be used as they come. burn_in sweeps are thrown away first, then every thin-th
+    # state is kept. Runs forever unless max_blocks is given.
+    # e.g for block in sampler.stream(10000,burn_in=1000,thin=5):
+    #	  counter.update(block)
+    def stream(self,block_size,chains=1,burn_in=0,thin=1,max_blocks=None,states=None):
+        if(burn_in>0):
+            self.run(1,chains,states,thin=burn_in)
+            states = self.states
+        blocks = 0
+        while(max_blocks==None or blocks<max_blocks):
+            yield self.run(block_size,chains,states,thin)
+            states = self.states
+            blocks += 1
+    
+    # puts all the cdf tables into one block of shared memory, so other processes can read them without getting a copy each.
+    # Returns the shared memory and where each table is in it.
+    def to_shared_memory(self):
+        sizes = [table.size for table in self.cdf_tables]
+        offsets = np.cumsum([0]+sizes)
+        memory = shared_memory.SharedMemory(create=True,size=max(1,int(offsets[-1]))*8)
+        flat = np.ndarray(int(offsets[-1]),dtype=float,buffer=memory.buf)
+        layout = []
+        for table,offset in zip(self.cdf_tables,offsets):
+            flat[offset:offset+table.size] = table.reshape(-1)
+            layout.append((int(offset),table.shape))
+        return memory,layout
+    
+    # a copy without the tables, rng or chain states, which is small and can be pickled to send to another process.
+    def without_tables(self):
+        light = copy.copy(self)
+        light.cdf_tables = None
+        light.rng = None
+        light.states = None
+        return light
+
+# The vectorized version of gibbs_sampling. Returns the names and a (chains, N, number of variables) array.
+def vectorized_gibbs_sampling(all_factors,known_vars,evidence,N,chains=1):
+    sampler = GibbsSampler(all_factors,known_vars,evidence)
+    return sampler.names,sampler.run(N,chains)
+
+# Running statistics which can be fed blocks of samples from a stream, one block at a time.
+# Blocks can be any shape as long as the last axis is the variables (in the order of names).
+# MarginalCounter counts how often each variable takes each value and gives the marginals as factors.
+class MarginalCounter:
+    def __init__(self,names,cardinalities):
+        self.names = list(names)
+        self.counts = [np.zeros(c) for c in cardinalities]
+    
+    def update(self,block):
+        block = block.reshape(-1,len(self.names))
+        for i in range(len(self.names)):
+            self.counts[i] += np.bincount(block[:,i],minlength=len(self.counts[i]))
+    
+    def marginals(self):
+        all_marginals = []
+        for name,counts in zip(self.names,self.counts):
+            marginal = factors.Factor([name],[len(counts)])
+            marginal.set_all(counts)
+            all_marginals.append(factors.condition(marginal))
+        return all_marginals
+
+# RunningMean keeps the count, mean and variance of each variable, merging in each block (Chan et al.'s parallel update)
+# so nothing but the three running numbers is stored.
+class RunningMean:
+    def __init__(self,number_of_variables):
+        self.count = 0
+        self.mean = np.zeros(number_of_variables)
+        self.squared_distance = np.zeros(number_of_variables)
+    
+    def update(self,block):
+        block = block.reshape(-1,len(self.mean)).astype(float)
+        block_count = block.shape[0]
+        if(block_count==0):
+            return
+        block_mean = np.mean(block,axis=0)
+        block_squared_distance = np.sum((block-block_mean)**2,axis=0)
+        total = self.count+block_count
+        delta = block_mean-self.mean
+        self.mean = self.mean+delta*block_count/total
+        self.squared_distance = self.squared_distance+block_squared_distance+delta**2*self.count*block_count/total
+        self.count = total
+    
+    def variance(self):
+        return self.squared_distance/max(1,self.count)
+
+# PARALLEL CHAINS
+# Runs independent Gibbs chains in a pool of processes. Each chain gets its own numpy Generator, spawned from one
+# SeedSequence so the streams don't overlap and the whole run can be repeated with the same seed. The cdf tables are
+# built once and put in shared memory, each worker process reads them from there instead of being sent its own copy.
+# With rhat_target set, the chains are run check_every sweeps at a time and stop as soon as every variable's R-hat is
+# below the target (or N sweeps have been done), otherwise N sweeps are run.
+# Returns the names, the (chains, sweeps done, number of variables) samples, and R-hat and effective sample size per variable.
+# Note with the "spawn" start method (Windows, macOS) the modules folder needs to be importable by the worker processes.
+def parallel_gibbs_sampling(all_factors,known_vars,evidence,N,chains=4,processes=None,seed=None,rhat_target=None,check_every=1000):
+    sampler = GibbsSampler(all_factors,known_vars,evidence)
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(chains)]
+    states = []
+    for rng in rngs:
+        sampler.rng = rng
+        states.append(sampler.initial_states(1))
+    memory,layout = sampler.to_shared_memory()
+    all_samples = []
+    try:
+        with multiprocessing.Pool(processes,initializer=attach_gibbs_worker,initargs=(sampler.without_tables(),memory.name,layout)) as pool:
+            done = 0
+            while(done<N):
+                if(rhat_target==None):
+                    steps = N
+                else:
+                    steps = min(check_every,N-done)
+                results = pool.map(run_gibbs_chain,[(rngs[c],states[c],steps) for c in range(chains)])
+                all_samples.append(np.concatenate([r[0] for r in results]))
+                states = [r[1] for r in results]
+                rngs = [r[2] for r in results]
+                done += steps
+                if(rhat_target!=None and np.max(gelman_rubin_rhat(np.concatenate(all_samples,axis=1)))<rhat_target):
+                    break
+    finally:
+        memory.close()
+        memory.unlink()
+    samples = np.concatenate(all_samples,axis=1)
+    return sampler.names,samples,gelman_rubin_rhat(samples),mcmc_effective_sample_size(samples)
+
+# Set up in each worker process: the sampler gets its tables as views into the shared memory.
+def attach_gibbs_worker(sampler,memory_name,layout):
+    global worker_sampler,worker_memory
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    sizes = [int(np.prod(shape)) for offset,shape in layout]
+    flat = np.ndarray(max(1,sum(sizes)),dtype=float,buffer=worker_memory.buf)
+    sampler.cdf_tables = [flat[offset:offset+size].reshape(shape) for (offset,shape),size in zip(layout,sizes)]
+    worker_sampler = sampler
+
+# Runs one chain in a worker. Sends back the samples, and the state and rng so the chain can carry on next time.
+def run_gibbs_chain(job):
+    rng,states,N = job
+    worker_sampler.rng = rng
+    samples = worker_sampler.run(N,states.shape[0],states)
+    return samples,worker_sampler.states,rng
+
+# CONVERGENCE DIAGNOSTICS
+# Both take (chains, N, number of variables) samples and give one number per variable, treating the values as numbers.
+# Split R-hat: each chain is cut in half and the variance between the halves' means is compared to the variance within
+# them. Close to 1 means the chains agree, a common rule is to wait until it is below 1.01.
+# Variables which never change (e.g evidence) get 1.
+def gelman_rubin_rhat(samples):
+    half = samples.shape[1]//2
+    split = np.concatenate([samples[:,:half],samples[:,half:2*half]]).astype(float)
+    n = split.shape[1]
+    within = np.mean(np.var(split,axis=1,ddof=1),axis=0)
+    between = n*np.var(np.mean(split,axis=1),axis=0,ddof=1)
+    var_plus = (n-1)/n*within+between/n
+    with np.errstate(divide="ignore",invalid="ignore"):
+        rhat = np.sqrt(var_plus/within)
+    rhat[(within==0)&(between==0)] = 1
+    rhat[(within==0)&(between>0)] = np.inf
+    return rhat
+
+# Effective sample size: how many independent samples the correlated chains are worth. The autocorrelation comes from an
+# FFT of each chain, combined over chains, and is summed in pairs until a pair goes negative (Geyer's initial positive sequence).
+# Variables which never change get the total number of samples.
+def mcmc_effective_sample_size(samples):
+    chains,n,num_vars = samples.shape
+    centered = samples-np.mean(samples,axis=1,keepdims=True)
+    transformed = np.fft.rfft(centered,n=2*n,axis=1)
+    autocovariance = np.fft.irfft(transformed*np.conj(transformed),axis=1)[:,:n]/n
+    within = np.mean(autocovariance[:,0]*n/max(1,n-1),axis=0)
+    if(chains>1):
+        between = np.var(np.mean(samples,axis=1),axis=0,ddof=1)
+    else:
+        between = np.zeros(num_vars)
+    var_plus = within*(n-1)/n+between
+    with np.errstate(divide="ignore",invalid="ignore"):
+        rho = 1-(within-np.mean(autocovariance,axis=0))/var_plus
+    rho[0] = 1
+    pairs = rho[0:n-1:2]+rho[1:n:2]
+    still_positive = np.cumprod(pairs>0,axis=0)
+    tau = -1+2*np.sum(pairs*still_positive,axis=0)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        ess = chains*n/tau
+    ess[(var_plus==0)|~(tau>0)] = chains*n
+    return ess
@@ -0,0 +1,255 @@
+import factors
+import numpy as np
+
+# SPARSE FACTORS
+# A Factor keeps a value for every combination of its variables, even when most of them are 0 (deterministic
+# relations, impossible states, factors reduced by evidence). A SparseFactor only keeps the combinations which aren't 0:
+# 1. coords, a 2d array with one row per nonzero combination and one column per variable.
+# 		e.g [[0,1]
+#			 [1,0]]
+# 2. values, the value of each of those rows e.g [0.4,0.6]
+# 3. the names and the shape (number of values of each variable), as for a Factor.
+# Every other combination is 0. Memory and time then go with the number of nonzeros rather than the size of the table.
+# The functions here take dense or sparse factors (or one of each) and pick the storage of the result by its density
+# (nonzeros/size): below density_threshold it is a SparseFactor, above it a normal Factor.
+# e.g f = factors_sparse.to_sparse(my_factor)
+#	  joint = factors_sparse.product(f,other_factor)
+#	  marginal = factors_sparse.marginalize(joint,["A"])
+# Sparse factors are only kept in normal space, a log space factor has to be moved out of log space first.
+
+density_threshold = 0.1
+
+class SparseFactor:
+	def __init__(self,names,pos_values,coords=None,values=None):
+		self.names = names
+		self.shape = tuple([int(p) for p in pos_values])
+		self.log_space = False
+		if(coords is None):
+			coords = np.zeros((0,len(names)),dtype=int)
+			values = np.zeros(0)
+		self.coords = np.asarray(coords,dtype=int).reshape(-1,len(names))
+		self.values = np.asarray(values,dtype=float).reshape(-1)
+
+	@property
+	def nnz(self):
+		return self.values.size
+
+	@property
+	def size(self):
+		return int(np.prod(self.shape))
+
+	def density(self):
+		return self.nnz/max(1,self.size)
+
+	# only the nonzero rows are shown.
+	def __repr__(self):
+		name_lengths = [len(str(n)) for n in self.names]
+		formatter = "".join(["{:<"+str(l+2)+"}" for l in name_lengths])+"{}"
+		strings = [formatter.format(*(self.names+["Values (10 dp), {} of {} nonzero".format(self.nnz,self.size)]))]
+		for index in np.argsort(self.flat_positions(),kind="stable"):
+			strings.append(formatter.format(*(list(self.coords[index])+[self.values[index].round(10)])))
+		return "".join([s+"\n" for s in strings])
+
+	# each nonzero row's position in the dense array.
+	def flat_positions(self):
+		return np.ravel_multi_index(self.coords.T,self.shape)
+
+	def get(self,index):
+		matches = np.all(self.coords==np.array(index),axis=1)
+		return float(np.sum(self.values[matches]))
+
+	# set the value at a given position e.g myfactor.set([0,1],0.3). Setting 0 removes the row.
+	def set(self,index,value):
+		if(len(index)!=len(self.names)):
+			raise Exception('length of index is incorrect. Provide {} values'.format(len(self.names)))
+		keep = ~np.all(self.coords==np.array(index),axis=1)
+		self.coords = self.coords[keep]
+		self.values = self.values[keep]
+		if(value!=0):
+			self.coords = np.vstack([self.coords,np.array(index,dtype=int).reshape(1,-1)])
+			self.values = np.append(self.values,value)
+
+	def copy(self):
+		return SparseFactor(self.names,self.shape,self.coords.copy(),self.values.copy())
+
+	def to_dense(self):
+		new_factor = factors.Factor(self.names,list(self.shape))
+		flat = np.zeros(self.size)
+		np.add.at(flat,self.flat_positions(),self.values)
+		new_factor.set_all(flat)
+		return new_factor
+
+def to_sparse(factor):
+	if(isinstance(factor,SparseFactor)):
+		return factor
+	if(factor.log_space):
+		raise Exception('sparse factors are kept in normal space. Use factors.to_linear_space first')
+	nonzero = np.nonzero(factor.array)
+	coords = np.array(nonzero,dtype=int).T.reshape(-1,factor.array.ndim)
+	return SparseFactor(factor.names,factor.array.shape,coords,factor.array[nonzero])
+
+def to_dense(factor):
+	if(isinstance(factor,SparseFactor)):
+		return factor.to_dense()
+	return factor
+
+def density(factor):
+	if(isinstance(factor,SparseFactor)):
+		return factor.density()
+	return np.count_nonzero(factor.array)/max(1,factor.array.size)
+
+# picks sparse or dense storage for a factor by its density.
+def choose_storage(factor,threshold=None):
+	if(threshold==None):
+		threshold = density_threshold
+	if(density(factor)<threshold):
+		return to_sparse(factor)
+	return to_dense(factor)
+
+# the same rows with duplicates (same combination twice) added together and zeros removed.
+def sum_duplicates(names,shape,coords,values):
+	unique_positions,inverse = np.unique(np.ravel_multi_index(coords.T,shape),return_inverse=True)
+	summed = np.bincount(inverse.reshape(-1),weights=values,minlength=unique_positions.size)
+	keep = summed!=0
+	new_coords = np.array(np.unravel_index(unique_positions[keep],shape),dtype=int).T.reshape(-1,len(shape))
+	return SparseFactor(names,shape,new_coords,summed[keep])
+
+# The same four pieces as in factors.py, done on the nonzero rows only.
+
+# 1. FACTOR CONDITIONING
+#		the sums are worked out per combination of the axis variables with np.bincount over the rows.
+#		zero_policy is as in factors.condition, except that with "nan" a slice which sums to 0 just stays empty (0)
+#		rather than being filled with nan. "uniform" fills empty slices in, which can make the factor much less sparse.
+def condition(factor,axis="none",zero_policy="nan",threshold=None):
+	if(not zero_policy in factors.zero_policies):
+		raise Exception('unknown zero_policy {}. Use one of {}'.format(zero_policy,factors.zero_policies))
+	if(not isinstance(factor,SparseFactor)):
+		return choose_storage(factors.condition(factor,axis,zero_policy),threshold)
+	names = factor.names
+	if(axis=="none" or len(axis)==0):
+		cond_var_index = []
+	else:
+		cond_var_index = [a for a in range(len(names)) if names[a] in axis]
+		if(len(cond_var_index)<1):
+			print("Error: couldn't find variable")
+			return None
+	cond_shape = [factor.shape[a] for a in cond_var_index]
+	if(len(cond_var_index)==0):
+		slice_of_row = np.zeros(factor.nnz,dtype=int)
+	else:
+		slice_of_row = np.ravel_multi_index(factor.coords[:,cond_var_index].T,cond_shape)
+	number_of_slices = int(np.prod(cond_shape))
+	sums = np.bincount(slice_of_row,weights=factor.values,minlength=number_of_slices)
+	zero_sums = (sums==0)
+	if(zero_policy=="raise" and np.any(zero_sums)):
+		raise Exception('{} slices sum to 0 and cannot be conditioned'.format(np.sum(zero_sums)))
+	coords = factor.coords
+	values = factor.values/sums[slice_of_row]
+	if(zero_policy=="uniform" and np.any(zero_sums)):
+		# every combination of the summed variables for each empty slice.
+		not_cond_var_index = [b for b in range(len(names)) if not b in cond_var_index]
+		slice_size = int(np.prod([factor.shape[b] for b in not_cond_var_index]))
+		empty_slices = np.nonzero(zero_sums)[0]
+		filled = np.zeros((empty_slices.size*slice_size,len(names)),dtype=int)
+		if(len(cond_var_index)>0):
+			filled[:,cond_var_index] = np.repeat(np.array(np.unravel_index(empty_slices,cond_shape)).T,slice_size,axis=0)
+		if(len(not_cond_var_index)>0):
+			inner = np.indices([factor.shape[b] for b in not_cond_var_index]).reshape(len(not_cond_var_index),-1).T
+			filled[:,not_cond_var_index] = np.tile(inner,(empty_slices.size,1))
+		coords = np.vstack([coords,filled])
+		values = np.append(values,np.full(filled.shape[0],1/slice_size))
+	return choose_storage(SparseFactor(names,factor.shape,coords,values),threshold)
+
+# 2. FACTOR MARGINALIZATION
+#		the rows which are left with the same combination after dropping the summed variables are added up.
+def marginalize(factor,axis="none",threshold=None):
+	if(not isinstance(factor,SparseFactor)):
+		result = factors.marginalize(factor,axis)
+		if(isinstance(result,factors.Factor)):
+			return choose_storage(result,threshold)
+		return result
+	names = factor.names
+	if(axis=="none" or len(axis)==len(names)):
+		return np.sum(factor.values)
+	marg_var_index = [a for a in range(len(names)) if names[a] in axis]
+	if(len(marg_var_index)<1):
+		return None
+	not_marg_var_index = [b for b in range(len(names)) if not b in marg_var_index]
+	new_names = [names[n] for n in not_marg_var_index]
+	new_shape = [factor.shape[n] for n in not_marg_var_index]
+	summed = sum_duplicates(new_names,new_shape,factor.coords[:,not_marg_var_index],factor.values)
+	return choose_storage(summed,threshold)
+
+# 3. FACTOR PRODUCT
+#		a sparse join: a row of factor1 only meets the rows of factor2 which agree on the shared variables. factor2's rows
+#		are sorted by their shared values, so for each row of factor1 the matching rows are one block found with
+#		searchsorted, and all the pairs are built at once with np.repeat. The result has at most nnz1*nnz2 rows and
+#		usually far fewer, rather than the size of the full table.
+def product(factor1,factor2,threshold=None):
+	if(not isinstance(factor1,SparseFactor) and not isinstance(factor2,SparseFactor)):
+		return choose_storage(factors.product(factor1,factor2),threshold)
+	factor1 = to_sparse(factor1)
+	factor2 = to_sparse(factor2)
+	names1 = list(factor1.names)
+	names2 = list(factor2.names)
+	joint_names = [n for n in names1 if n in names2]
+	extra_names = [n for n in names2 if not n in joint_names]
+	new_names = names1+extra_names
+	shape_of = dict(list(zip(names1,factor1.shape))+list(zip(names2,factor2.shape)))
+	new_shape = [shape_of[n] for n in new_names]
+	joint_shape = [shape_of[n] for n in joint_names]
+	if(len(joint_names)>0):
+		key1 = np.ravel_multi_index(factor1.coords[:,[names1.index(n) for n in joint_names]].T,joint_shape)
+		key2 = np.ravel_multi_index(factor2.coords[:,[names2.index(n) for n in joint_names]].T,joint_shape)
+	else:
+		key1 = np.zeros(factor1.nnz,dtype=int)
+		key2 = np.zeros(factor2.nnz,dtype=int)
+	order2 = np.argsort(key2,kind="stable")
+	sorted_key2 = key2[order2]
+	starts = np.searchsorted(sorted_key2,key1,side="left")
+	ends = np.searchsorted(sorted_key2,key1,side="right")
+	matches = ends-starts
+	rows1 = np.repeat(np.arange(factor1.nnz),matches)
+	# position within each block, plus where the block starts.
+	block_offsets = np.arange(rows1.size)-np.repeat(np.cumsum(matches)-matches,matches)
+	rows2 = order2[np.repeat(starts,matches)+block_offsets]
+	extra_columns = [names2.index(n) for n in extra_names]
+	new_coords = np.hstack([factor1.coords[rows1],factor2.coords[rows2][:,extra_columns]])
+	new_values = factor1.values[rows1]*factor2.values[rows2]
+	keep = new_values!=0
+	return choose_storage(SparseFactor(new_names,new_shape,new_coords[keep],new_values[keep]),threshold)
+
+# 4. DROP VARIABLES
+#		keeps the rows with the selected values and removes those variables' columns.
+def drop_variables(factor,axis,values,threshold=None):
+	if(not isinstance(factor,SparseFactor)):
+		result = factors.drop_variables(factor,axis,values)
+		if(result is None):
+			return None
+		return choose_storage(result,threshold)
+	names = factor.names
+	var_index = [a for a in range(len(names)) if names[a] in axis]
+	if(len(var_index)<1):
+		return factor
+	elif(len(var_index)==len(names)):
+		return None
+	not_var_index = [b for b in range(len(names)) if not b in var_index]
+	selected = np.array([values[axis.index(names[a])] for a in var_index],dtype=int)
+	keep = np.all(factor.coords[:,var_index]==selected,axis=1)
+	new_names = [names[n] for n in not_var_index]
+	new_shape = [factor.shape[n] for n in not_var_index]
+	new_factor = SparseFactor(new_names,new_shape,factor.coords[keep][:,not_var_index],factor.values[keep])
+	return choose_storage(new_factor,threshold)
+
+def multiple_factor_product(all_factors,threshold=None):
+	joint_factor = all_factors[0]
+	for i in range(1,len(all_factors)):
+		joint_factor = product(joint_factor,all_factors[i],threshold)
+	return joint_factor
+
+# draws from the nonzero rows only. Returns one row of variable values per sample, as factors.sample does.
+def sample(factor,number_of_samples):
+	if(not isinstance(factor,SparseFactor)):
+		return factors.sample(factor,number_of_samples)
+	rows = np.random.choice(np.arange(factor.nnz),number_of_samples,p=factor.values/np.sum(factor.values))
+	return factor.coords[rows].reshape(number_of_samples,len(factor.names))
@@ -0,0 +1,244 @@
+import factors
+import factors_inference
+import numpy as np
+import math
+import multiprocessing
+from collections import OrderedDict
+
+# STRUCTURE SEARCH
+# Searches for the graph (which variables are parents of which) of a directed PGM that best explains some data.
+# Graphs are scored with a Bayesian (Dirichlet) score: the log probability of the data with the parameters integrated out.
+# For a variable with r values whose parents have q combinations, with counts N_jk (parent combination j, value k),
+# N_j = sum_k N_jk and Dirichlet pseudocounts a_jk (a_j = sum_k a_jk), the score of that family (variable + parents) is
+#		sum_j [ lgamma(a_j)-lgamma(a_j+N_j) + sum_k lgamma(a_jk+N_jk)-lgamma(a_jk) ]
+# and the score of the graph is the sum over every family. "bdeu" spreads equivalent_sample_size pseudocounts evenly
+# over every cell (a_jk = ess/(r*q)), "k2" gives every cell a pseudocount of 1.
+# Because the score is a sum over families, changing one edge only changes the score of one family (two for a reversal).
+# Family scores are kept in an LRU cache keyed by the variable and its set of parents, so each step of the search only
+# scores the families it hasn't seen before.
+# Rows where any variable of a family is missing (-1) are left out of that family's counts.
+# e.g search = factors_structure.StructureSearch(sample_variable_names,samples)
+#	  parents,score = search.hill_climb()
+#	  new_factors = search.to_factors(parents)
+# parents is a dictionary from each variable to the list of its parents e.g {"A":[],"B":[],"C":["A","B"]}.
+
+log_gamma = np.vectorize(math.lgamma,otypes=[float])
+
+# the Bayesian score of one family from its counts, which have the variable on the first axis and its parents after.
+def bayesian_family_score(counts,score_type="bdeu",equivalent_sample_size=1):
+	counts = counts.reshape(counts.shape[0],-1)
+	r,q = counts.shape
+	if(score_type=="bdeu"):
+		alpha = equivalent_sample_size/(r*q)
+	elif(score_type=="k2"):
+		alpha = 1
+	else:
+		raise Exception('unknown score type {}, use "bdeu" or "k2"'.format(score_type))
+	parent_counts = np.sum(counts,axis=0)
+	score = np.sum(math.lgamma(alpha*r)-log_gamma(alpha*r+parent_counts))
+	score += np.sum(log_gamma(alpha+counts)-math.lgamma(alpha))
+	return float(score)
+
+class StructureSearch:
+	def __init__(self,data_variable_names,data,cardinalities=None,score_type="bdeu",equivalent_sample_size=1,max_parents=None,cache_size=10000):
+		self.names = list(data_variable_names)
+		self.data = np.asarray(data)
+		if(cardinalities is None):
+			cardinalities = list(np.max(self.data,axis=0)+1)
+		self.cardinalities = [int(c) for c in cardinalities]
+		self.score_type = score_type
+		self.equivalent_sample_size = equivalent_sample_size
+		self.max_parents = max_parents
+		self.cache_size = cache_size
+		self.cache = OrderedDict()
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.history = []
+
+	# parents always go in the order of the data columns, so the same set always gives the same counts.
+	def family_key(self,node,parents):
+		return (node,frozenset(parents))
+
+	def compute_family_score(self,node,parents):
+		names = [node]+sorted(parents,key=self.names.index)
+		shape = [self.cardinalities[self.names.index(n)] for n in names]
+		counts = factors_inference.count_family(names,shape,self.names,self.data)
+		return bayesian_family_score(counts,self.score_type,self.equivalent_sample_size)
+
+	def cache_score(self,key,score):
+		self.cache[key] = score
+		self.cache.move_to_end(key)
+		while(len(self.cache)>self.cache_size):
+			self.cache.popitem(last=False)
+
+	def family_score(self,node,parents):
+		key = self.family_key(node,parents)
+		if(key in self.cache):
+			self.cache_hits += 1
+			self.cache.move_to_end(key)
+			return self.cache[key]
+		self.cache_misses += 1
+		score = self.compute_family_score(node,parents)
+		self.cache_score(key,score)
+		return score
+
+	# scores a list of (node,parents) families, only working out the ones which aren't in the cache.
+	# With a pool (of processes processes) those are shared out over the processes. Returns a dictionary by family key, so scores needed
+	# in this step can't be pushed out of a small cache before they are used.
+	def family_scores(self,families,pool=None,processes=1):
+		scores = {}
+		missing = []
+		missing_keys = set()
+		for node,parents in families:
+			key = self.family_key(node,parents)
+			if(key in scores or key in missing_keys):
+				continue
+			if(key in self.cache):
+				self.cache_hits += 1
+				self.cache.move_to_end(key)
+				scores[key] = self.cache[key]
+			else:
+				missing.append((node,list(parents)))
+				missing_keys.add(key)
+		self.cache_misses += len(missing)
+		if(pool==None):
+			results = [self.compute_family_score(node,parents) for node,parents in missing]
+		else:
+			results = pool.map(family_score_worker,missing,chunksize=max(1,len(missing)//(4*processes)))
+		for (node,parents),score in zip(missing,results):
+			key = self.family_key(node,parents)
+			scores[key] = score
+			self.cache_score(key,score)
+		return scores
+
+	def score(self,parents):
+		return sum([self.family_score(n,parents[n]) for n in self.names])
+
+	# True if there is a directed path from start to end following parent -> child edges.
+	def has_path(self,parents,start,end):
+		children = dict([(n,[m for m in self.names if n in parents[m]]) for n in self.names])
+		seen = set([start])
+		to_visit = [start]
+		while(len(to_visit)>0):
+			n = to_visit.pop()
+			if(n==end):
+				return True
+			for c in children[n]:
+				if(not c in seen):
+					seen.add(c)
+					to_visit.append(c)
+		return False
+
+	# every legal single edge change: ("add",u,v) adds u->v, ("remove",u,v) removes it and ("reverse",u,v) turns it into v->u.
+	# Each comes with the new parents of the families it changes.
+	def candidate_moves(self,parents):
+		moves = []
+		for v in self.names:
+			for u in self.names:
+				if(u==v):
+					continue
+				if(u in parents[v]):
+					moves.append((("remove",u,v),[(v,[p for p in parents[v] if p!=u])]))
+					# reversing is fine unless there is another path from u to v, which would close a cycle.
+					without_edge = dict(parents)
+					without_edge[v] = [p for p in parents[v] if p!=u]
+					if(self.allowed(parents[u]+[v]) and not self.has_path(without_edge,u,v)):
+						moves.append((("reverse",u,v),[(v,without_edge[v]),(u,parents[u]+[v])]))
+				elif(self.allowed(parents[v]+[u]) and not self.has_path(parents,v,u)):
+					moves.append((("add",u,v),[(v,parents[v]+[u])]))
+		return moves
+
+	def allowed(self,parent_list):
+		return self.max_parents==None or len(parent_list)<=self.max_parents
+
+	# Greedy hill climbing: at each step take the single edge change which improves the score most, and stop when none do.
+	# Returns the parents and the score. self.history has the score after every step.
+	def hill_climb(self,initial_parents=None,max_iterations=1000,processes=None):
+		if(initial_parents is None):
+			initial_parents = dict([(n,[]) for n in self.names])
+		parents = dict([(n,list(initial_parents.get(n,[]))) for n in self.names])
+		pool = None
+		if(processes!=None):
+			pool = multiprocessing.Pool(processes,initializer=attach_structure_worker,initargs=(self.without_cache(),))
+		try:
+			current = self.family_scores([(n,parents[n]) for n in self.names],pool,processes)
+			score = sum(current.values())
+			self.history = [score]
+			for iteration in range(max_iterations):
+				moves = self.candidate_moves(parents)
+				new_scores = self.family_scores([family for move,families in moves for family in families],pool,processes)
+				best_move = None
+				best_change = 0
+				for move,families in moves:
+					change = sum([new_scores[self.family_key(n,p)]-current[self.family_key(n,parents[n])] for n,p in families])
+					if(change>best_change+1e-9):
+						best_move = (move,families)
+						best_change = change
+				if(best_move==None):
+					break
+				for n,p in best_move[1]:
+					parents[n] = p
+					current[self.family_key(n,p)] = new_scores[self.family_key(n,p)]
+				score += best_change
+				self.history.append(score)
+		finally:
+			if(pool!=None):
+				pool.close()
+				pool.join()
+		return parents,score
+
+	# K2: given an order of the variables, each variable greedily takes parents from the variables before it, adding the
+	# one which improves its family score most until none do (or it has max_parents).
+	def k2(self,order=None,processes=None):
+		if(order is None):
+			order = self.names
+		# the search's own names, so an array of names gives the same parent lists.
+		order = [self.names[self.names.index(n)] for n in order]
+		parents = dict([(n,[]) for n in self.names])
+		pool = None
+		if(processes!=None):
+			pool = multiprocessing.Pool(processes,initializer=attach_structure_worker,initargs=(self.without_cache(),))
+		try:
+			for i,v in enumerate(order):
+				score = self.family_score(v,parents[v])
+				while(self.max_parents==None or len(parents[v])<self.max_parents):
+					options = [u for u in order[:i] if not u in parents[v]]
+					if(len(options)==0):
+						break
+					new_scores = self.family_scores([(v,parents[v]+[u]) for u in options],pool,processes)
+					best = max(options,key=lambda u: new_scores[self.family_key(v,parents[v]+[u])])
+					best_score = new_scores[self.family_key(v,parents[v]+[best])]
+					if(best_score<=score+1e-9):
+						break
+					parents[v] = parents[v]+[best]
+					score = best_score
+		finally:
+			if(pool!=None):
+				pool.close()
+				pool.join()
+		return parents,self.score(parents)
+
+	# the factors for a graph, each variable first then its parents, fitted to the data with Dirichlet pseudocounts prior.
+	def to_factors(self,parents,prior=1):
+		templates = []
+		for n in self.names:
+			names = [n]+list(parents[n])
+			templates.append(factors.Factor(names,[self.cardinalities[self.names.index(m)] for m in names]))
+		return factors_inference.fit_counts(templates,self.names,self.data,prior=prior)
+
+	# a copy to send to worker processes, which don't need the cache.
+	def without_cache(self):
+		search = StructureSearch.__new__(StructureSearch)
+		search.__dict__.update(self.__dict__)
+		search.cache = OrderedDict()
+		search.history = []
+		return search
+
+# Each worker process keeps its own copy of the search (and the data) so only the families are sent for each step.
+def attach_structure_worker(search):
+	global worker_search
+	worker_search = search
+
+def family_score_worker(family):
+	node,parents = family
+	return worker_search.compute_family_score(node,parents)
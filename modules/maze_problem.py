@@ -1,4 +1,9 @@
 import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sparse_linalg
+import time
+import heapq
+import warnings
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.animation as animation
@@ -7,149 +12,124 @@ from IPython.display import HTML,Image
 rc('animation', html='html5')
 
 
+# The maze is a grid of tiles: 'W' wall, 'B' blank, 'F' fire, 'G' gold and 'S' the start. Every tile which isn't a
+# wall is a state, numbered along the rows e.g state_index below.
+# Each action (L,R,U,D) moves the agent that way with probability 0.7 and to each side with 0.15, moving into a wall
+# leaves it where it is. Gold sends the agent back to the start.
+# The transitions are built with array shifts rather than by searching for each neighbour:
+# 1. state_index is the grid with the state number in each tile and -1 for walls. Padding it with -1 and shifting it
+#		by one tile in each direction gives every state's neighbour in that direction (or -1 for a wall).
+# 2. successors[a,s] is the three states action a can lead to from s and probabilities[a,s] how likely each is, so the
+#		model takes O(S) memory rather than O(S^2).
+# 3. sparse_transition_matrices[a] is the same thing as a scipy.sparse CSR matrix with the next state in rows and the
+#		current state in columns (the same layout as the dense matrices).
+# The dense matrices (left_transition_matrix etc.) are only built when something asks for them, they are S x S so
+# should be avoided for big mazes.
+actions = ['L','R','U','D']
+# for each action, the intended direction and the two directions it can slip to, as (row,col) steps.
+action_moves = {'L':[(0,-1),(-1,0),(1,0)],
+                'R':[(0,1),(-1,0),(1,0)],
+                'U':[(-1,0),(0,1),(0,-1)],
+                'D':[(1,0),(0,1),(0,-1)]}
+move_probabilities = np.array([0.7,0.15,0.15])
+
+# Tiles for drawing the maze, 8x8 each. The number in a tile picks its colour from tile_colours.
+tile_colours = ['grey','black','red','yellow','pink']
+empty_tile = np.zeros((8,8))
+wall_tile = np.ones((8,8))
+fire_tile = np.array([[0,0,0,0,0,0,0,0],
+                      [0,0,0,0,0,0,0,0],
+                      [0,0,0,0,0,1,0,0],
+                      [0,0,0,0,0,0,0,0],
+                      [0,0,0,0,1,0,0,0],
+                      [0,0,1,0,1,0,0,0],
+                      [0,0,1,1,0,1,0,0],
+                      [0,1,1,0,1,1,1,0]])*2
+gold_tile = np.array([[0,0,0,0,0,0,0,0],
+                      [0,0,0,0,0,0,0,0],
+                      [0,0,0,1,1,0,0,0],
+                      [0,0,1,0,0,1,0,0],
+                      [0,0,1,0,0,1,0,0],
+                      [0,0,0,1,1,0,0,0],
+                      [0,0,0,0,0,0,0,0],
+                      [0,0,0,0,0,0,0,0]])*3
+person_tile = np.array([[0,0,0,1,0,0,0,0],
+                        [0,1,1,1,1,1,0,0],
+                        [0,0,0,1,0,0,0,0],
+                        [0,0,0,1,0,0,0,0],
+                        [0,0,1,1,1,0,0,0],
+                        [0,0,1,0,1,0,0,0],
+                        [0,0,1,0,1,0,0,0],
+                        [0,0,1,0,1,0,0,0]])*4
+tile_symbols = ['B','W','F','G','S']
+tile_stack = np.array([empty_tile,wall_tile,fire_tile,gold_tile,empty_tile])
+
 class Maze:
     def __init__(self,world):
         rows = world.shape[0]
         cols = world.shape[1]
-        all_possible_positions = []
-        starting_position = []
-        gold_states = []
-        index = 0
-        for row in range(rows):
-            for col in range(cols):
-                if(not world[row,col]=='W'):
-                    all_possible_positions.append([row,col])
-                    if(world[row,col]=='S'):
-                        starting_position = [row,col]
-                    if(world[row,col]=='G'):
-                        gold_states.append(index)
-                    index+=1
-        number_of_states = len(all_possible_positions)
-        
-        def get_position_index(position):
-            for i in range(number_of_states):
-                if(position[0]==all_possible_positions[i][0] and position[1]==all_possible_positions[i][1]):
-                    return i
-            return None
+        open_tiles = (world!='W')
+        state_index = np.full((rows,cols),-1,dtype=int)
+        state_index[open_tiles] = np.arange(np.sum(open_tiles))
+        number_of_states = int(np.sum(open_tiles))
+        positions = np.argwhere(open_tiles)
         
-        initial_state = get_position_index(starting_position)
-        
-        left_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            left_pos = [pos[0],pos[1]-1]
-            left_move_index = get_position_index(left_pos)
-            if left_move_index==None:
-                left_transition_matrix[i,i]+=0.7
-            else:
-                left_transition_matrix[left_move_index,i]+=0.7
-            
-            up_pos = [pos[0]-1,pos[1]]
-            up_move_index = get_position_index(up_pos)
-            if up_move_index==None:
-                left_transition_matrix[i,i]+=0.15
-            else:
-                left_transition_matrix[up_move_index,i]+=0.15
-            
-            down_pos = [pos[0]+1,pos[1]]
-            down_move_index = get_position_index(down_pos)
-            if down_move_index==None:
-                left_transition_matrix[i,i]+=0.15
-            else:
-                left_transition_matrix[down_move_index,i]+=0.15
+        padded = np.pad(state_index,1,constant_values=-1)
+        states = np.arange(number_of_states)
+        def neighbours(step):
+            neighbour = padded[positions[:,0]+1+step[0],positions[:,1]+1+step[1]]
+            # into a wall (or off the grid), stay put.
+            return np.where(neighbour<0,states,neighbour)
         
-        right_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            right_pos = [pos[0],pos[1]+1]
-            right_move_index = get_position_index(right_pos)
-            if right_move_index==None:
-                right_transition_matrix[i,i]+=0.7
-            else:
-                right_transition_matrix[right_move_index,i]+=0.7
-            
-            up_pos = [pos[0]-1,pos[1]]
-            up_move_index = get_position_index(up_pos)
-            if up_move_index==None:
-                right_transition_matrix[i,i]+=0.15
-            else:
-                right_transition_matrix[up_move_index,i]+=0.15
-            
-            down_pos = [pos[0]+1,pos[1]]
-            down_move_index = get_position_index(down_pos)
-            if down_move_index==None:
-                right_transition_matrix[i,i]+=0.15
-            else:
-                right_transition_matrix[down_move_index,i]+=0.15
+        gold_states = state_index[world=='G']
+        initial_state = int(state_index[world=='S'][0])
+        successors = np.zeros((len(actions),number_of_states,3),dtype=int)
+        probabilities = np.zeros((len(actions),number_of_states,3))
+        for a,action in enumerate(actions):
+            for m,step in enumerate(action_moves[action]):
+                successors[a,:,m] = neighbours(step)
+            probabilities[a] = move_probabilities
+        successors[:,gold_states,:] = initial_state
+        probabilities[:,gold_states,:] = [1,0,0]
         
-        down_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            down_pos = [pos[0]+1,pos[1]]
-            down_move_index = get_position_index(down_pos)
-            if down_move_index==None:
-                down_transition_matrix[i,i]+=0.7
-            else:
-                down_transition_matrix[down_move_index,i]+=0.7
-            
-            right_pos = [pos[0],pos[1]+1]
-            right_move_index = get_position_index(right_pos)
-            if right_move_index==None:
-                down_transition_matrix[i,i]+=0.15
-            else:
-                down_transition_matrix[right_move_index,i]+=0.15
-            
-            left_pos = [pos[0],pos[1]-1]
-            left_move_index = get_position_index(left_pos)
-            if left_move_index==None:
-                down_transition_matrix[i,i]+=0.15
-            else:
-                down_transition_matrix[left_move_index,i]+=0.15
-        
-        up_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            up_pos = [pos[0]-1,pos[1]]
-            up_move_index = get_position_index(up_pos)
-            if up_move_index==None:
-                up_transition_matrix[i,i]+=0.7
-            else:
-                up_transition_matrix[up_move_index,i]+=0.7
-            
-            right_pos = [pos[0],pos[1]+1]
-            right_move_index = get_position_index(right_pos)
-            if right_move_index==None:
-                up_transition_matrix[i,i]+=0.15
-            else:
-                up_transition_matrix[right_move_index,i]+=0.15
-            
-            left_pos = [pos[0],pos[1]-1]
-            left_move_index = get_position_index(left_pos)
-            if left_move_index==None:
-                up_transition_matrix[i,i]+=0.15
-            else:
-                up_transition_matrix[left_move_index,i]+=0.15
-            
-        left_transition_matrix[:,gold_states]=0
-        left_transition_matrix[initial_state,gold_states]=1
-        right_transition_matrix[:,gold_states]=0
-        right_transition_matrix[initial_state,gold_states]=1
-        up_transition_matrix[:,gold_states]=0
-        up_transition_matrix[initial_state,gold_states]=1
-        down_transition_matrix[:,gold_states]=0
-        down_transition_matrix[initial_state,gold_states]=1
-
-        self.left_transition_matrix = left_transition_matrix
-        self.right_transition_matrix = right_transition_matrix
-        self.up_transition_matrix = up_transition_matrix
-        self.down_transition_matrix = down_transition_matrix
-        self.num_states = index
+        self.successors = successors
+        self.probabilities = probabilities
+        self.sparse_transition_matrices = [self.build_sparse_matrix(a) for a in range(len(actions))]
+        self.state_index = state_index
+        self.positions = positions
+        self.gold_states = gold_states
+        self.num_states = number_of_states
         self.world = world
-        self.initial_state = get_position_index(starting_position)
+        self.initial_state = initial_state
+        self._dense_matrices = {}
+    
+    # CSR matrix of P(next state | current state) for one action, next state in rows. Repeated successors (e.g two
+    # moves into walls) are added together.
+    def build_sparse_matrix(self,a):
+        S = self.successors.shape[1]
+        current = np.repeat(np.arange(S),3)
+        return sparse.csr_matrix((self.probabilities[a].reshape(-1),(self.successors[a].reshape(-1),current)),shape=(S,S))
+    
+    def dense_matrix(self,action):
+        if(not action in self._dense_matrices):
+            self._dense_matrices[action] = self.sparse_transition_matrices[actions.index(action)].toarray()
+        return self._dense_matrices[action]
+    
+    @property
+    def left_transition_matrix(self):
+        return self.dense_matrix('L')
+    
+    @property
+    def right_transition_matrix(self):
+        return self.dense_matrix('R')
+    
+    @property
+    def up_transition_matrix(self):
+        return self.dense_matrix('U')
+    
+    @property
+    def down_transition_matrix(self):
+        return self.dense_matrix('D')
     
     def show_on_map_str(self,values=[], set_W_blank=True):
         index = 0
@@ -198,86 +178,76 @@ class Maze:
         state_str = self.show_on_map_str(np.arange(self.num_states))
         return world_str + " world map" "\n" + state_str + " state map"
     
-    def get_policy_matrix(self,policy_vals):        
-        policy_matrix = np.zeros_like(self.left_transition_matrix)
-        for p in range(len(policy_vals)):
-            state_p_policy = policy_vals[p]
-            if(state_p_policy=='U'):
-                policy_matrix[:,p]=self.up_transition_matrix[:,p]
-            if(state_p_policy=='D'):
-                policy_matrix[:,p]=self.down_transition_matrix[:,p]
-            if(state_p_policy=='L'):
-                policy_matrix[:,p]=self.left_transition_matrix[:,p]
-            if(state_p_policy=='R'):
-                policy_matrix[:,p]=self.right_transition_matrix[:,p]        
-        
-        return policy_matrix
+    # the transition matrix when following a policy, e.g ['R','U',...] with one action per state. States with anything
+    # else (e.g "na") get a column of zeros. With sparse=True it is a CSR matrix, which is much smaller for big mazes.
+    def get_policy_matrix(self,policy_vals,sparse_matrix=False):
+        S = self.num_states
+        policy_actions = np.array([actions.index(p) if p in actions else -1 for p in policy_vals],dtype=int)
+        chosen = np.nonzero(policy_actions>=0)[0]
+        current = np.repeat(chosen,3)
+        policy_matrix = sparse.csr_matrix((self.probabilities[policy_actions[chosen],chosen].reshape(-1),
+                                           (self.successors[policy_actions[chosen],chosen].reshape(-1),current)),shape=(S,S))
+        if(sparse_matrix):
+            return policy_matrix
+        return policy_matrix.toarray()
     
     def sample_policy(self,transition_matrix,steps):
-        if(not np.isnan(transition_matrix).any()):
-            state_index = self.initial_state
-            state_hist = [state_index]
-            for iteration in range(steps):
-                state_index = np.random.choice(transition_matrix.shape[1],p=transition_matrix[:,state_index])
-                state_hist.append(state_index)
-            return state_hist
+        if(sparse.issparse(transition_matrix) or not np.isnan(transition_matrix).any()):
+            states,returns = Rollouts(transition_matrix).run(1,steps,self.initial_state)
+            return states[0].tolist()
         else:
             print("no policy yet")
             return
     
-    def make_animation(self,transition_matrix,steps):
-        empty_tile = np.zeros((8,8))
-        wall_tile = np.ones((8,8))
-        fire_tile = np.array([[0,0,0,0,0,0,0,0],
-                              [0,0,0,0,0,0,0,0],
-                              [0,0,0,0,0,1,0,0],
-                              [0,0,0,0,0,0,0,0],
-                              [0,0,0,0,1,0,0,0],
-                              [0,0,1,0,1,0,0,0],
-                              [0,0,1,1,0,1,0,0],
-                              [0,1,1,0,1,1,1,0]])*2
-        gold_tile = np.array([[0,0,0,0,0,0,0,0],
-                              [0,0,0,0,0,0,0,0],
-                              [0,0,0,1,1,0,0,0],
-                              [0,0,1,0,0,1,0,0],
-                              [0,0,1,0,0,1,0,0],
-                              [0,0,0,1,1,0,0,0],
-                              [0,0,0,0,0,0,0,0],
-                              [0,0,0,0,0,0,0,0]])*3
-        person_tile = np.array([[0,0,0,1,0,0,0,0],
-                                [0,1,1,1,1,1,0,0],
-                                [0,0,0,1,0,0,0,0],
-                                [0,0,0,1,0,0,0,0],
-                                [0,0,1,1,1,0,0,0],
-                                [0,0,1,0,1,0,0,0],
-                                [0,0,1,0,1,0,0,0],
-                                [0,0,1,0,1,0,0,0]])*4
-        symbol_to_tile = dict(zip(['B','W','F','G','S'],[empty_tile,wall_tile,fire_tile,gold_tile,empty_tile]))
+    # many episodes at once from the start, see Rollouts. Returns the (episodes,steps+1) states and each episode's return.
+    def rollouts(self,transition_matrix,episodes,steps,reward=None,discount=1):
+        return Rollouts(transition_matrix).run(episodes,steps,self.initial_state,reward,discount)
     
+    # the picture of the maze without the agent, one 8x8 tile per square, made once and kept. Each square's tile is
+    # looked up from a stack of tiles in one go and the (rows,cols,8,8) result is laid out as an image. The tile codes
+    # (0-4, see tile_colours) are kept as uint8.
+    def background_image(self):
+        if(not hasattr(self,'_background')):
+            symbol_codes = np.array([tile_symbols.index(symbol) for symbol in self.world.reshape(-1)]).reshape(self.world.shape)
+            rows,cols = self.world.shape
+            self._background = tile_stack[symbol_codes].transpose(0,2,1,3).reshape(rows*8,cols*8).astype(np.uint8)
+        return self._background
+    
+    # the pixels of the square of a state, as a slice so it can be used on the frame or the background.
+    def square(self,state,scale=1):
+        row,col = self.positions[state]
+        return (slice(row*8*scale,(row+1)*8*scale),slice(col*8*scale,(col+1)*8*scale))
+    
+    # one frame: the background with the agent tile drawn over the square of state.
+    # With out, the frame is drawn into out. If previous_state is the state out was last drawn for, only its square is
+    # put back from the background, so a frame costs two squares rather than the whole image.
+    def render_frame(self,state,out=None,previous_state=None):
+        background = self.background_image()
+        if(out is None):
+            out = background.copy()
+        elif(previous_state is None):
+            out[:] = background
+        else:
+            previous_square = self.square(previous_state)
+            out[previous_square] = background[previous_square]
+        square = out[self.square(state)]
+        square[person_tile>0] = person_tile[person_tile>0]
+        return out
+    
+    def make_animation(self,transition_matrix,steps):
         states = self.sample_policy(transition_matrix,steps)
         world = self.world
         
-        images = []
-        for i in range(len(states)):
-            state = states[i]
-            image = np.zeros((world.shape[0]*8,world.shape[1]*8))
-            index = 0
-            for row in range(world.shape[0]):
-                for col in range(world.shape[1]):
-                    tile = symbol_to_tile[world[row,col]]
-                    image[row*8:(row+1)*8,col*8:(col+1)*8]=tile
-                    if(not world[row,col]=='W'):
-                        if(index==state):
-                            image[row*8:(row+1)*8,col*8:(col+1)*8][person_tile>0]=person_tile[person_tile>0]
-                        index+=1
-            images.append(image)
-        
         fig = plt.figure(figsize=(world.shape[1]/2,world.shape[0]/2))
         fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
-        im = plt.imshow(images[0],cmap=colors.ListedColormap(['grey','black','red','yellow','pink']))
+        frame = self.render_frame(states[0])
+        drawn = [states[0]]
+        im = plt.imshow(frame,cmap=colors.ListedColormap(tile_colours),vmin=0,vmax=len(tile_colours)-1)
 
+        # frames are drawn when the animation asks for them, into the same array, rather than all kept in a list.
         def animate_func(i):
-            im.set_array(images[i])
+            im.set_array(self.render_frame(states[i],frame,drawn[0]))
+            drawn[0] = states[i]
             return
         
         anim = animation.FuncAnimation(fig, 
@@ -289,4 +259,270 @@ class Maze:
         html = HTML(anim.to_jshtml())
         display(html)
         plt.close()
+    
+    # Writes the frames for a list of states (e.g from sample_policy, or one row of rollouts) to a file one at a time,
+    # so long episodes take constant memory. Between frames only the squares the agent left and moved to are redrawn.
+    # .npy: a stack of frames (tile codes 0-4, see tile_colours) written into a memory mapped file.
+    # .gif/.mp4 (or anything else imageio can write): RGB frames, each pixel scaled up to scale x scale. Needs imageio
+    # (and imageio-ffmpeg for mp4).
+    def export_animation(self,states,path,fps=5,scale=4):
+        frame = self.render_frame(states[0])
+        if(path.endswith(".npy")):
+            stack = np.lib.format.open_memmap(path,mode="w+",dtype=np.uint8,shape=(len(states),)+frame.shape)
+            for i,state in enumerate(states):
+                stack[i] = self.render_frame(state,frame,states[i-1] if i>0 else None)
+            stack.flush()
+            del stack
+            return
+        try:
+            import imageio.v2 as imageio
+        except ImportError:
+            raise Exception('exporting to {} needs imageio (pip install imageio), or use a .npy path'.format(path))
+        palette = (np.array([colors.to_rgb(c) for c in tile_colours])*255).astype(np.uint8)
+        # the scaled RGB frame is kept as well and only the two changed squares are coloured in again.
+        rgb = np.repeat(np.repeat(palette[frame],scale,axis=0),scale,axis=1)
+        with imageio.get_writer(path,fps=fps) as writer:
+            for i,state in enumerate(states):
+                changed = [state] if i==0 else [states[i-1],state]
+                self.render_frame(state,frame,states[i-1] if i>0 else None)
+                for s in changed:
+                    rgb[self.square(s,scale)] = np.repeat(np.repeat(palette[frame[self.square(s)]],scale,axis=0),scale,axis=1)
+                writer.append_data(rgb)
+    
+# SOLVERS
+# These work on any MDP given as one transition matrix per action (next state in rows, current state in columns, dense
+# or sparse, e.g maze.sparse_transition_matrices) and a reward for being in each state. The value of a state is
+#       V(s) = reward(s) + discount * max_a sum_s' P(s'|s,a) V(s')
+# All the actions are stacked into one sparse (A*S) x S matrix with row a*S+s holding P(.|s,a), so the value of every
+# action in every state is one sparse matrix-vector product, reshaped to (A,S).
+# Both solvers return the values and a greedy policy, with one action name per state, which works with get_policy_matrix.
+# e.g solver = maze_problem.ValueIteration(maze.sparse_transition_matrices,reward,0.95)
+#     values,policy = solver.run()
+#     maze.make_animation(maze.get_policy_matrix(policy),20)
+
+def stack_transition_matrices(transition_matrices):
+    return sparse.vstack([sparse.csr_matrix(T).T for T in transition_matrices]).tocsr()
+
+# the value of taking each action in each state given the values of the next states, shape (A,S).
+def action_values(stacked,reward,discount,values):
+    S = len(reward)
+    return reward+discount*(stacked.dot(values)).reshape(-1,S)
+
+# the update for every state. The reward is the same for every action so it is added after the max, on S values not A*S.
+def bellman_update(stacked,reward,discount,values):
+    S = len(reward)
+    return reward+discount*np.max(stacked.dot(values).reshape(-1,S),axis=0)
 
+class MDPSolver:
+    def __init__(self,transition_matrices,reward,discount,action_names=None):
+        self.stacked = stack_transition_matrices(transition_matrices)
+        self.reward = np.asarray(reward,dtype=float)
+        self.discount = discount
+        self.number_of_actions = len(transition_matrices)
+        self.number_of_states = len(self.reward)
+        if(action_names is None):
+            action_names = actions if self.number_of_actions==len(actions) else list(range(self.number_of_actions))
+        self.action_names = list(action_names)
+        self.residuals = []
+    
+    def greedy_policy(self,values):
+        return [self.action_names[a] for a in np.argmax(action_values(self.stacked,self.reward,self.discount,values),axis=0)]
+    
+    # the transition matrix (current state in rows) for a policy given as one action number per state.
+    def policy_rows(self,policy_actions):
+        return self.stacked[policy_actions*self.number_of_states+np.arange(self.number_of_states)]
+
+# Value iteration: apply the update above to every state at once until the largest change (the Bellman residual) is
+# below tolerance. self.residuals has the residual after every sweep, self.updates_per_second counts state updates
+# (S per sweep) to compare with PrioritizedSweeping.
+class ValueIteration(MDPSolver):
+    def run(self,tolerance=1e-6,max_iterations=100000,initial_values=None):
+        if(initial_values is None):
+            initial_values = np.zeros(self.number_of_states)
+        values = np.array(initial_values,dtype=float)
+        self.residuals = []
+        start_time = time.perf_counter()
+        for iteration in range(max_iterations):
+            new_values = bellman_update(self.stacked,self.reward,self.discount,values)
+            residual = np.max(np.abs(new_values-values))
+            values = new_values
+            self.residuals.append(residual)
+            if(residual<tolerance):
+                break
+        self.updates = len(self.residuals)*self.number_of_states
+        self.updates_per_second = self.updates/max(time.perf_counter()-start_time,1e-12)
+        return values,self.greedy_policy(values)
+
+# Policy iteration: work out the exact value of the current policy by solving the sparse linear system
+#       (I - discount * P_policy) V = reward
+# then switch every state to its best action under those values. Stops when no state changes action. A state only
+# changes if another action is better by more than tolerance (relative to the largest value), so ties and rounding
+# in the solve can't make it go round in circles.
+# Up to direct_limit states the system is solved directly (spsolve). Past that the fill-in of a direct solve on a big
+# grid takes too long and too much memory, so it is solved iteratively with BiCGSTAB, starting from the last
+# policy's values (which are usually close).
+# Each round only improves states which can already see a better path, so on a big grid with a distant reward it takes
+# rounds in proportion to the distance. There, ValueIteration is faster, or its policy can be used as initial_policy.
+# self.residuals has the Bellman residual of each policy's values.
+class PolicyIteration(MDPSolver):
+    def evaluate(self,policy_actions,previous_values=None,direct_limit=20000,solver_tolerance=1e-10):
+        system = sparse.identity(self.number_of_states,format="csr")-self.discount*self.policy_rows(policy_actions)
+        if(self.number_of_states<=direct_limit):
+            return sparse_linalg.spsolve(system.tocsc(),self.reward)
+        values,info = sparse_linalg.bicgstab(system,self.reward,x0=previous_values,rtol=solver_tolerance,atol=0)
+        if(info!=0):
+            warnings.warn('policy evaluation did not converge, BiCGSTAB info {}'.format(info))
+        return values
+    
+    def run(self,initial_policy=None,max_iterations=1000,tolerance=1e-8):
+        S = self.number_of_states
+        if(initial_policy is None):
+            policy_actions = np.argmax(action_values(self.stacked,self.reward,self.discount,np.zeros(S)),axis=0)
+        else:
+            policy_actions = np.array([self.action_names.index(p) for p in initial_policy],dtype=int)
+        self.residuals = []
+        values = None
+        for iteration in range(max_iterations):
+            values = self.evaluate(policy_actions,values)
+            q = action_values(self.stacked,self.reward,self.discount,values)
+            self.residuals.append(np.max(np.abs(np.max(q,axis=0)-values)))
+            best = np.argmax(q,axis=0)
+            improves = q[best,np.arange(S)]>q[policy_actions,np.arange(S)]+tolerance*np.max(np.abs(values))
+            if(not np.any(improves)):
+                break
+            policy_actions = np.where(improves,best,policy_actions)
+        return values,[self.action_names[a] for a in policy_actions]
+
+# Prioritized sweeping: asynchronous value iteration which updates one state at a time, always the state with the
+# largest Bellman error |update(V)(s)-V(s)|, rather than sweeping every state. On a big maze most states don't change
+# on most sweeps (only a frontier spreading out from the rewards does), and this skips them.
+# 1. Each state's transitions are copied out of the matrix into padded (S,A,K) successor and probability arrays (K the
+#		most next states any action has, padding has probability 0), like Maze.successors. Updating a few states is then
+#		a handful of small array operations.
+# 2. predecessors of s are the states which can move to s under some action. When V(s) changes only their Bellman
+#		errors can change, so only they are recomputed and pushed onto the heap.
+# 3. The heap (heapq) holds (-error,state). Entries which are out of date (the state's error has changed since) are
+#		skipped when popped. errors always holds every state's current Bellman error, so the top of the heap is the
+#		Bellman residual over all the states.
+# self.residuals has (number of updates, seconds, residual) every report_every updates, and self.updates_per_second is
+# the rate over the whole run, to compare with ValueIteration.
+# e.g solver = maze_problem.PrioritizedSweeping(maze.sparse_transition_matrices,reward,0.95)
+#     values,policy = solver.run(tolerance=1e-6)
+class PrioritizedSweeping(MDPSolver):
+    def __init__(self,transition_matrices,reward,discount,action_names=None):
+        MDPSolver.__init__(self,transition_matrices,reward,discount,action_names)
+        S = self.number_of_states
+        A = self.number_of_actions
+        # rows of the stacked matrix in state order (row s*A+a is P(.|s,a)).
+        state_major = self.stacked[(np.arange(S).reshape(-1,1)+S*np.arange(A).reshape(1,-1)).reshape(-1)]
+        row_lengths = np.diff(state_major.indptr)
+        width = max(1,int(np.max(row_lengths))) if S>0 else 1
+        slot = np.arange(state_major.nnz)-np.repeat(state_major.indptr[:-1],row_lengths)
+        rows = np.repeat(np.arange(S*A),row_lengths)
+        self.successors = np.zeros((S*A,width),dtype=int)
+        self.probabilities = np.zeros((S*A,width))
+        self.successors[rows,slot] = state_major.indices
+        self.probabilities[rows,slot] = state_major.data
+        self.successors = self.successors.reshape(S,A,width)
+        self.probabilities = self.probabilities.reshape(S,A,width)
+        # predecessors as a CSR matrix: the columns of row s are the states which can move to s.
+        predecessors = sparse.csr_matrix((np.ones(state_major.nnz),(state_major.indices,rows//A)),shape=(S,S))
+        self.predecessor_indptr = predecessors.indptr
+        self.predecessor_indices = predecessors.indices
+    
+    # the update for one state, or for an array of states at once (e.g all the predecessors of a state).
+    def backup(self,states,values):
+        expected = (self.probabilities[states]*values[self.successors[states]]).sum(axis=-1)
+        return self.reward[states]+self.discount*expected.max(axis=-1)
+    
+    def run(self,tolerance=1e-6,max_updates=10**8,initial_values=None,report_every=10000):
+        S = self.number_of_states
+        if(initial_values is None):
+            initial_values = np.zeros(S)
+        values = np.array(initial_values,dtype=float)
+        errors = np.abs(bellman_update(self.stacked,self.reward,self.discount,values)-values)
+        heap = [(-errors[s],s) for s in np.nonzero(errors>=tolerance)[0]]
+        heapq.heapify(heap)
+        self.residuals = []
+        start_time = time.perf_counter()
+        updates = 0
+        while(len(heap)>0 and updates<max_updates):
+            negative_error,s = heapq.heappop(heap)
+            if(-negative_error!=errors[s]):
+                continue
+            if(updates%report_every==0):
+                self.residuals.append((updates,time.perf_counter()-start_time,errors[s]))
+            values[s] = self.backup(s,values)
+            errors[s] = 0
+            updates += 1
+            predecessors = self.predecessor_indices[self.predecessor_indptr[s]:self.predecessor_indptr[s+1]]
+            new_errors = np.abs(self.backup(predecessors,values)-values[predecessors])
+            for p,error in zip(predecessors.tolist(),new_errors.tolist()):
+                if(error!=errors[p]):
+                    errors[p] = error
+                    if(error>=tolerance):
+                        heapq.heappush(heap,(-error,p))
+        elapsed = time.perf_counter()-start_time
+        self.residuals.append((updates,elapsed,np.max(errors) if S>0 else 0))
+        self.updates = updates
+        self.updates_per_second = updates/max(elapsed,1e-12)
+        return values,self.greedy_policy(values)
+
+# ROLLOUTS
+# Simulates many episodes of a policy at once, with the current state of every episode held in one vector.
+# transition_matrix is a policy's matrix (next state in rows, current state in columns, dense or sparse), e.g from
+# get_policy_matrix. The CDF of every column is precomputed in one go: the nonzero probabilities of all the columns are
+# laid end to end, and each column's running total (its CDF, ending at 1) has the column number added to it. So column c
+# covers the range (c,c+1] and the whole thing is sorted. A step for every episode at once is then
+#       position = searchsorted(cdfs, current_state + uniform random number)
+# which lands inside the current state's column, and the next state is the row of that entry.
+# run returns an (episodes,steps+1) int array of states (the first column is the start) and, given a reward for each
+# state, the discounted return of each episode (rewards summed from the start state on, as in the notebooks).
+# e.g states,returns = maze_problem.Rollouts(maze.get_policy_matrix(policy)).run(10000,50,maze.initial_state,reward,0.95)
+class Rollouts:
+    def __init__(self,transition_matrix):
+        columns = sparse.csc_matrix(transition_matrix)
+        columns.sum_duplicates()
+        columns.eliminate_zeros()
+        S = columns.shape[1]
+        lengths = np.diff(columns.indptr)
+        column_of_entry = np.repeat(np.arange(S),lengths)
+        # each column's CDF is summed within that column only (k-th entry of every column at once), so the rounding
+        # doesn't grow with the number of states. The last entry is then exactly 1 and the column ends exactly at c+1.
+        within = np.array(columns.data,dtype=float)
+        starts = columns.indptr[:-1]
+        for k in range(1,int(np.max(lengths,initial=0))):
+            longer = starts[lengths>k]
+            within[longer+k] += within[longer+k-1]
+        ends = columns.indptr[1:][lengths>0]-1
+        within /= np.repeat(within[ends],lengths[lengths>0])
+        within[ends] = 1
+        self.cdfs = column_of_entry+within
+        self.next_states = columns.indices
+        self.indptr = columns.indptr
+        self.number_of_states = S
+        self.state_dtype = np.int32 if S<2**31 else np.int64
+    
+    def step(self,states,rng=np.random):
+        stuck = self.indptr[states+1]==self.indptr[states]
+        if(np.any(stuck)):
+            raise Exception('state {} has no transitions (no action chosen for it?)'.format(states[np.nonzero(stuck)[0][0]]))
+        positions = np.searchsorted(self.cdfs,states+rng.random(len(states)),side="right")
+        # c+u can still round onto a CDF value at either end of the column, keep every position inside its own column.
+        positions = np.clip(positions,self.indptr[states],self.indptr[states+1]-1)
+        return self.next_states[positions]
+    
+    def run(self,episodes,steps,start_states,reward=None,discount=1,rng=np.random):
+        states = np.zeros((episodes,steps+1),dtype=self.state_dtype)
+        states[:,0] = start_states
+        for t in range(steps):
+            states[:,t+1] = self.step(states[:,t],rng)
+        returns = None
+        if(reward is not None):
+            returns = np.asarray(reward,dtype=float)[states].dot(discount**np.arange(steps+1))
+        return states,returns
+    
+    # the first step each episode is in one of the target states, or -1 if it never gets there.
+    def hitting_times(self,states,target_states):
+        hits = np.isin(states,target_states)
+        return np.where(np.any(hits,axis=1),np.argmax(hits,axis=1),-1)